@@ -65,12 +65,15 @@ setup(
         "zstandard",  # For xbps support.
     ],
     extras_require={
+        "fast-validation": [
+            "fastjsonschema",
+        ],
         "test": [
             "black",
             "flake8",
             "pep8-naming",
             "flake8-isort",
-        ]
+        ],
     },
     cmdclass={
         "develop": CompletionDevelop,
@@ -186,6 +186,24 @@ def handle_plan_args(cfg, plan, args):
     if args.keep_going:
         plan.keep_going = True
 
+    jobs = args.jobs
+    if jobs is None:
+        try:
+            jobs = _parse_jobs(os.environ.get("XBSTRAP_JOBS", "1"))
+        except argparse.ArgumentTypeError:
+            raise xbstrap.exceptions.GenericError("XBSTRAP_JOBS must be an integer or 'auto'")
+    if jobs < 0:
+        raise xbstrap.exceptions.GenericError("Number of jobs must not be negative")
+    if jobs == 0:
+        # Only count CPUs that we are allowed to run on (e.g., in CI containers).
+        jobs = xbstrap.base.get_concurrency()
+    plan.jobs = jobs
+
+    if args.fetch_jobs is not None:
+        if args.fetch_jobs < 1:
+            raise xbstrap.exceptions.GenericError("Number of fetch jobs must be positive")
+        plan.fetch_jobs = args.fetch_jobs
+
     if args.progress_file is not None:
         plan.progress_file = xbstrap.cli_utils.open_file_from_cli(args.progress_file, "wt")
 
@@ -193,6 +211,16 @@ def handle_plan_args(cfg, plan, args):
         plan.isolate_sysroots = args.sysroot_isolation
 
 
+# Parses the argument of -j; "auto" (or 0) selects the number of available CPUs.
+def _parse_jobs(value):
+    if value == "auto":
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer or 'auto', got {value!r}")
+
+
 handle_plan_args.parser = argparse.ArgumentParser(add_help=False)
 handle_plan_args.parser.add_argument(
     "--randomize-plan",
@@ -250,6 +278,21 @@ handle_plan_args.parser.add_argument(
     action="store_true",
     help="continue running even if some build steps fail",
 )
+handle_plan_args.parser.add_argument(
+    "-j",
+    "--jobs",
+    type=_parse_jobs,
+    metavar="N",
+    help="run up to N independent build steps in parallel;"
+    " N = auto (or 0) uses the number of available CPUs;"
+    " defaults to $XBSTRAP_JOBS (or 1) if the option is not given",
+)
+handle_plan_args.parser.add_argument(
+    "--fetch-jobs",
+    type=int,
+    metavar="N",
+    help="fetch up to N sources in parallel (default: 8)",
+)
 handle_plan_args.parser.add_argument(
     "--progress-file",
     type=str,
@@ -898,6 +941,8 @@ def do_prereqs(args):
         info_url = (
             "https://api.github.com/repos/managarm/xbstrap-maintainer-utilities/releases/latest"
         )
+        import urllib.request  # Only needed here, see _util.interactive_download().
+
         releases = json.load(urllib.request.urlopen(info_url))
         url = releases["tarball_url"]
         tar_path = os.path.join(home, f"xmu-{releases['name']}.tar.gz")
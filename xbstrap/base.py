@@ -1,26 +1,39 @@
 # SPDX-License-Identifier: MIT
 
+import atexit
 import collections
+import concurrent.futures
 import errno
-import filecmp
+import functools
 import hashlib
+import heapq
+import itertools
 import json
+import marshal
 import os
 import re
 import shlex
 import shutil
 import stat
 import subprocess
+import sys
 import tarfile
 import tempfile
-import urllib.request
+import threading
+import time
+import urllib.parse
 import zipfile
-from enum import Enum
+from enum import Enum, IntEnum
 
 import colorama
 import jsonschema
 import yaml
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
 import xbstrap.util as _util
 import xbstrap.vcs_utils as _vcs_utils
 import xbstrap.xbps_utils as _xbps_utils
@@ -30,51 +43,186 @@ from xbstrap.util import eprint  # special cased since it's used a lot
 verbosity = False
 debug_manifests = False
 
+# We stick to the safe loaders: the BaseLoaders do not resolve ints and bools, which the
+# schema and the rest of xbstrap rely on.
 global_yaml_loader = yaml.SafeLoader
+global_yaml_dumper = yaml.SafeDumper
 global_bootstrap_validator = None
+_fast_bootstrap_validator = None
 native_yaml_available = False
 
+# Parsed config files, keyed by path, modification time, size and options.
+_yml_memo = dict()
+
 try:
     global_yaml_loader = yaml.CSafeLoader
+    global_yaml_dumper = yaml.CSafeDumper
     native_yaml_available = True
 except AttributeError:
     pass
 
 
+schema_path = os.path.join(os.path.dirname(__file__), "schema.yml")
+_schema_fingerprint = None
+_schema_yml = None
+
+
+# Identifies the schema that config files are validated against.
+# Cached configs are only valid as long as the schema does not change.
+def get_schema_fingerprint():
+    global _schema_fingerprint
+    if _schema_fingerprint is None:
+        schema_stat = os.stat(schema_path)
+        _schema_fingerprint = f"{schema_stat.st_mtime_ns}:{schema_stat.st_size}"
+    return _schema_fingerprint
+
+
+# Loads the schema. If cache_dir is given, a JSON copy of the schema is kept there since
+# JSON can be loaded much faster than YAML. The schema is only loaded once per process.
+def load_schema(cache_dir=None):
+    global _schema_yml
+    if _schema_yml is None:
+        _schema_yml = _load_schema_uncached(cache_dir)
+    return _schema_yml
+
+
+def _load_schema_uncached(cache_dir):
+    json_path = None
+    if cache_dir is not None:
+        json_path = os.path.join(cache_dir, "schema.json")
+        try:
+            with open(json_path, "r") as f:
+                cached = json.load(f)
+            if cached["fingerprint"] == get_schema_fingerprint():
+                return cached["schema"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    with open(schema_path, "rb") as f:
+        schema_yml = yaml.load(f, Loader=global_yaml_loader)
+
+    if json_path is not None:
+        _util.try_mkdir(cache_dir, recursive=True)
+        with tempfile.NamedTemporaryFile("w+", dir=cache_dir, delete=False) as temp_f:
+            json.dump({"fingerprint": get_schema_fingerprint(), "schema": schema_yml}, temp_f)
+        os.replace(temp_f.name, json_path)
+    return schema_yml
+
+
 # Returns true if the file validates without any warnings.
 # Throws an exception on hard validation errors.
-def validate_bootstrap_yaml(yml, path):
-    global global_bootstrap_validator
+def validate_bootstrap_yaml(yml, path, *, cache_dir=None):
+    errors = _find_validation_errors(yml, path, cache_dir=cache_dir)
+    _report_validation_errors(errors)
+    return not errors
+
+
+# Returns a list of error messages (empty if the file validates without any warnings).
+# Unlike validate_bootstrap_yaml(), this does not print anything, such that it can be called
+# from worker processes (see Config._read_ymls()).
+def _find_validation_errors(yml, path, *, cache_dir=None):
+    global global_bootstrap_validator, _fast_bootstrap_validator
+    # If available, fastjsonschema compiles the schema to Python code, which validates much
+    # faster than jsonschema. It only reports the first error though, so we still fall back
+    # to jsonschema to report errors.
+    if fastjsonschema is not None:
+        if not _fast_bootstrap_validator:
+            _fast_bootstrap_validator = fastjsonschema.compile(load_schema(cache_dir))
+        try:
+            _fast_bootstrap_validator(yml)
+            return []
+        except fastjsonschema.JsonSchemaException:
+            pass
+
     if not global_bootstrap_validator:
-        schema_path = os.path.join(os.path.dirname(__file__), "schema.yml")
-        with open(schema_path, "r") as f:
-            schema_yml = yaml.load(f, Loader=global_yaml_loader)
-        global_bootstrap_validator = jsonschema.Draft7Validator(schema_yml)
+        global_bootstrap_validator = jsonschema.Draft7Validator(load_schema(cache_dir))
 
-    any_errors = False
-    n = 0
+    errors = []
     for e in global_bootstrap_validator.iter_errors(yml):
-        if n == 0:
-            _util.log_err("Failed to validate boostrap.yml")
-        _util.log_err(
+        if not errors:
+            errors.append("Failed to validate boostrap.yml")
+        errors.append(
             "* Error in file: {}, YAML element: {}\n           {}".format(
                 path, "/".join(str(elem) for elem in e.absolute_path), e.message
             )
         )
-        any_errors = True
-        n += 1
-        if n >= 10:
-            _util.log_err("Reporting only the first 10 errors")
+        if len(errors) > 10:
+            errors.append("Reporting only the first 10 errors")
             break
+    return errors
 
-    if any_errors:
+
+def _report_validation_errors(errors):
+    for msg in errors:
+        _util.log_err(msg)
+    if errors:
         _util.log_warn("Validation issues will become hard errors in the future")
-    return not any_errors
+
+
+# Name of the cfg_cache file for a given config file. The suffix identifies the file format;
+# older versions of xbstrap used JSON files without a suffix.
+@functools.lru_cache(maxsize=None)
+def _cfg_cache_name(refpath):
+    return hashlib.sha256(refpath.encode("utf-8")).hexdigest() + ".marshal"
+
+
+# Returns a copy of a parsed config tree with all dict keys interned. Keys are drawn from a
+# small vocabulary, interning them saves memory and speeds up lookups (neither the YAML loader
+# nor marshal interns strings).
+def _intern_yml_keys(yml):
+    if isinstance(yml, dict):
+        return {
+            (sys.intern(k) if isinstance(k, str) else k): _intern_yml_keys(v)
+            for (k, v) in yml.items()
+        }
+    if isinstance(yml, list):
+        return [_intern_yml_keys(v) for v in yml]
+    return yml
+
+
+# Parses and validates a single config file. This is a free function such that it can run
+# in worker processes (see Config._read_ymls()). Returns (yml, validation errors).
+def _load_cfg_file(path, y4_args, debug_out_path, cache_dir):
+    if y4_args is not None:
+        # Keep y4's output as bytes, libyaml decodes it itself (see below).
+        y4_result = subprocess.run(
+            y4_args,
+            stdout=subprocess.PIPE,
+        )
+        if y4_result.returncode != 0:
+            raise GenericError(f"y4 invocation failed: {y4_args}")
+
+        y4_out = y4_result.stdout
+        if debug_out_path is not None:
+            with open(debug_out_path, "wb") as f:
+                f.write(y4_out)
+        yml = yaml.load(y4_out, Loader=global_yaml_loader)
+    else:
+        # Handle plain old YAML files.
+        # Binary mode lets libyaml decode the input itself rather than round-tripping
+        # through Python's text layer.
+        with open(path, "rb") as f:
+            yml = yaml.load(f, Loader=global_yaml_loader)
+
+    return (yml, _find_validation_errors(yml, path, cache_dir=cache_dir))
 
 
 def touch(path):
-    with open(path, "w"):
-        pass
+    # Avoid the overhead of a Python file object, we never write any data.
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+
+
+def files_equal(path_a, path_b, blocksize=1 << 20):
+    with open(path_a, "rb") as fa, open(path_b, "rb") as fb:
+        # Files of different sizes cannot be equal; this avoids reading them at all.
+        if os.fstat(fa.fileno()).st_size != os.fstat(fb.fileno()).st_size:
+            return False
+        while True:
+            chunk_a = fa.read(blocksize)
+            if chunk_a != fb.read(blocksize):
+                return False
+            if not chunk_a:
+                return True
 
 
 def try_unlink(path):
@@ -101,6 +249,13 @@ def stat_mtime(path):
         return None
 
 
+def _write_all(fd, buf):
+    view = memoryview(buf)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
 def num_allocated_cpus():
     try:
         cpuset = os.sched_getaffinity(0)
@@ -118,7 +273,18 @@ def get_concurrency():
     return n
 
 
+_at_var_regex = re.compile(r"@([\w:-]+)@")
+
+
+# resolve is either a function that maps variable names to values (or None)
+# or a dict of variables.
 def replace_at_vars(string, resolve):
+    # Most strings do not contain any variables; skip the regex for them.
+    if "@" not in string:
+        return string
+    if isinstance(resolve, dict):
+        resolve = resolve.get
+
     def do_substitute(m):
         varname = m.group(1)
         result = resolve(varname)
@@ -126,42 +292,114 @@ def replace_at_vars(string, resolve):
             raise GenericError("Unexpected substitution {}".format(varname))
         return result
 
-    return re.sub(r"@([\w:-]+)@", do_substitute, string)
+    return _at_var_regex.sub(do_substitute, string)
 
 
 def installtree(src_root, dest_root):
-    for name in os.listdir(src_root):
-        src_path = os.path.join(src_root, name)
-        dest_path = os.path.join(dest_root, name)
-
-        # We do islink before isdir, as isdir resolves symlinks
-        if os.path.islink(src_path):
-            try_unlink(dest_path)
-            # Do not preserve attributes
-            os.symlink(os.readlink(src_path), dest_path)
-        elif os.path.isdir(src_path):
-            if not os.access(dest_path, os.F_OK):
+    # Directories are created synchronously (files can only be copied once their parent
+    # directory exists) while file copies are spread over a thread pool.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_concurrency()) as executor:
+        futures = []
+        _installtree(src_root, dest_root, executor, futures)
+        for future in futures:
+            future.result()
+
+
+# errnos that indicate that a kernel-side copy is not possible for a given pair of files.
+_KERNEL_COPY_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EPERM,
+}
+
+
+# Returns False if copy_fn cannot be used to copy the file; raises on other errors.
+def _kernel_copy(copy_fn, src_fd, dest_fd, blocksize):
+    copied = 0
+    try:
+        while True:
+            n = copy_fn(src_fd, dest_fd, blocksize)
+            if not n:
+                return True
+            copied += n
+    except OSError as e:
+        if copied or e.errno not in _KERNEL_COPY_UNSUPPORTED:
+            raise
+        return False
+
+
+# Like shutil.copy2() but lets the kernel copy the data if possible: copy_file_range() avoids
+# copies through userspace and creates reflinks on filesystems that support them (e.g., btrfs,
+# XFS). sendfile() and a plain read/write loop are used as fallbacks.
+def _copy_file(src_path, dest_path):
+    try_unlink(dest_path)
+    with open(src_path, "rb") as src_f, open(dest_path, "wb") as dest_f:
+        src_fd = src_f.fileno()
+        dest_fd = dest_f.fileno()
+        blocksize = min(max(os.fstat(src_fd).st_size, 2**23), 2**30)
+
+        done = False
+        if hasattr(os, "copy_file_range"):
+            done = _kernel_copy(os.copy_file_range, src_fd, dest_fd, blocksize)
+        if not done and hasattr(os, "sendfile"):
+            done = _kernel_copy(
+                lambda src_fd, dest_fd, n: os.sendfile(dest_fd, src_fd, None, n),
+                src_fd,
+                dest_fd,
+                blocksize,
+            )
+        if not done:
+            shutil.copyfileobj(src_f, dest_f)
+    shutil.copystat(src_path, dest_path)
+
+
+def _installtree(src_root, dest_root, executor, futures):
+    # Walk the tree iteratively, deep package hierarchies would otherwise cost one Python
+    # stack frame per level.
+    stack = [(src_root, dest_root)]
+    while stack:
+        (src_dir, dest_dir) = stack.pop()
+        with os.scandir(src_dir) as it:
+            entries = list(it)
+        for entry in entries:
+            # entry.name is never absolute, so we can skip os.path.join() here.
+            dest_path = f"{dest_dir}/{entry.name}"
+
+            # DirEntry caches the file type, so these checks do not need additional stat()
+            # calls. We do is_symlink before is_dir, as is_dir resolves symlinks by default.
+            if entry.is_symlink():
+                try_unlink(dest_path)
+                # Do not preserve attributes
+                os.symlink(os.readlink(entry.path), dest_path)
+            elif entry.is_dir(follow_symlinks=False):
                 # We only copy attributes when the directory is first created.
-                os.mkdir(dest_path)
-                shutil.copystat(src_path, dest_path)
+                try:
+                    os.mkdir(dest_path)
+                except FileExistsError:
+                    pass
+                else:
+                    shutil.copystat(entry.path, dest_path)
 
-            installtree(src_path, dest_path)
-        else:
-            try_unlink(dest_path)
-            shutil.copy2(src_path, dest_path)
+                stack.append((entry.path, dest_path))
+            else:
+                futures.append(executor.submit(_copy_file, entry.path, dest_path))
 
 
 def touchtree(root):
-    for name in os.listdir(root):
-        path = os.path.join(root, name)
-
-        os.utime(path, (0, 0), follow_symlinks=False)
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                os.utime(entry.path, (0, 0), follow_symlinks=False)
 
-        if not os.path.islink(path) and os.path.isdir(path):
-            touchtree(path)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
 
 
-class ResetMode(Enum):
+class ResetMode(IntEnum):
     NONE = 0
     RESET = 1
     HARD_RESET = 2
@@ -174,6 +412,8 @@ class ItemSettings:
         # 2 = Check even for "crazy" updates (e.g., modification of VCS tags).
         self.check_remotes = 0
         self.reset = ResetMode.NONE
+        # Maps (URL, ref) pairs to remote commits (see vcs_utils.prefetch_remote_commits()).
+        self.remote_commits = None
 
 
 class ItemState:
@@ -185,6 +425,66 @@ class ItemState:
         self.timestamp = timestamp
 
 
+# Caches the sentinel files (e.g., fetched.xbstrap or <pkg>.installed) that record the state
+# of build steps. Each directory is scanned once instead of stat()ing every sentinel; the
+# mtime of a sentinel is only retrieved if the sentinel actually exists.
+class SentinelCache:
+    suffixes = (".xbstrap", ".installed")
+
+    def __init__(self):
+        self._dirs = dict()  # Maps directories to dicts (name -> os.DirEntry).
+
+    def clear(self):
+        self._dirs.clear()
+
+    def invalidate(self, dirpath):
+        self._dirs.pop(dirpath, None)
+
+    def _scan(self, dirpath):
+        entries = dict()
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.name.endswith(self.suffixes):
+                        entries[entry.name] = entry
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return entries
+
+    # Scans multiple directories concurrently. On cold caches, this overlaps the I/O
+    # that would otherwise be done one directory at a time while the plan is computed.
+    def prime(self, dirpaths):
+        todo = [dirpath for dirpath in set(dirpaths) if dirpath not in self._dirs]
+        if len(todo) < 2:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=get_concurrency()) as executor:
+            for dirpath, entries in zip(todo, executor.map(self._scan, todo)):
+                self._dirs[dirpath] = entries
+
+    def mtime(self, path):
+        (dirpath, name) = os.path.split(path)
+        entries = self._dirs.get(dirpath)
+        if entries is None:
+            entries = self._scan(dirpath)
+            self._dirs[dirpath] = entries
+
+        entry = entries.get(name)
+        if entry is None:
+            return None
+        try:
+            return entry.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def touch(self, path):
+        touch(path)
+        self.invalidate(os.path.dirname(path))
+
+    def unlink(self, path):
+        os.unlink(path)
+        self.invalidate(os.path.dirname(path))
+
+
 ArtifactFile = collections.namedtuple("ArtifactFile", ["name", "filepath", "architecture"])
 
 
@@ -257,7 +557,8 @@ class Config:
         self.debug_cfg_files = debug_cfg_files
         self.ignore_cfg_cache = ignore_cfg_cache
 
-        self._build_root_override = None if path == "" else path
+        # xbstrap never changes its working directory, hence the build root can be fixed here.
+        self._build_root = os.getcwd() if path == "" else path
         self._config_path = path
         self._root_yml = None
         self._site_yml = dict()
@@ -269,6 +570,15 @@ class Config:
         self._tasks = dict()
         self._site_archs = set()
         self._cached_repodata = dict()
+        self._repodata_lock = threading.Lock()  # Protects _cached_repodata.
+        # xbps-rindex does a read-modify-write of the repository index, hence all updates of
+        # the local repository need to be serialized.
+        self.xbps_repository_lock = threading.Lock()
+        self._sentinel_cache = SentinelCache()
+        self._cached_xbps_pkg_states = dict()  # Maps sysroots to dicts (name -> state).
+        self._xbps_pkg_states_lock = threading.Lock()  # Protects _cached_xbps_pkg_states.
+        self._option_decls = None  # Maps option names to their declarations.
+        self._resolved_options = None  # Tuple (options, options_key) for non-root files.
 
         self._bootstrap_path = changed_source_root or os.path.join(
             path, os.path.dirname(os.readlink(os.path.join(path, "bootstrap.link")))
@@ -280,7 +590,7 @@ class Config:
         self._root_yml = self._read_yml(root_path, is_root=True)
 
         try:
-            with open(os.path.join(path, "bootstrap-site.yml"), "r") as f:
+            with open(os.path.join(path, "bootstrap-site.yml"), "rb") as f:
                 self._site_yml = yaml.load(f, Loader=global_yaml_loader)
 
         except FileNotFoundError:
@@ -288,131 +598,183 @@ class Config:
 
         commit_path = os.path.join(self._bootstrap_path, "bootstrap-commits.yml")
         try:
-            with open(commit_path, "r") as f:
+            with open(commit_path, "rb") as f:
                 self._commit_yml = yaml.load(f, Loader=global_yaml_loader)
         except FileNotFoundError:
             pass
 
+        # This also collects all architectures that this build uses into _site_archs.
         self._parse_yml(root_path, self._root_yml)
 
-        # Collect all architectures that this build uses.
-        for tool in self._tool_pkgs.values():
-            arch = tool.architecture
-            if arch != "noarch":
-                self._site_archs.add(arch)
-        for pkg in self._target_pkgs.values():
-            arch = pkg.architecture
-            if arch != "noarch":
-                self._site_archs.add(arch)
-
     def _read_yml(self, path, *, is_root):
-        # Determine the extension of the config file.
-        ext = None
-        for candidate in [".y4.yml", ".yml"]:
-            if path.endswith(candidate):
-                ext = candidate
-                break
-        if ext is None:
-            raise GenericError(f"Config file {path} has no recognized extension")
-        noext_path = path.removesuffix(ext)
+        return self._read_ymls([path], is_root=is_root)[0]
 
+    # Reads multiple config files. Files that are neither memoized nor cached are parsed and
+    # validated in parallel worker processes (both steps are CPU bound).
+    def _read_ymls(self, paths, *, is_root):
         if is_root:
             options = {}
+            options_key = json.dumps(options)
         else:
             # Note that all_options and get_option_value() are available here.
-            options = {name: self.get_option_value(name) for name in self.all_options}
-
-        # Try to read the cached file.
-        refpath = os.path.realpath(path)
-        h = hashlib.sha256()
-        h.update(refpath.encode("utf-8"))
-        cache_name = h.hexdigest()
+            # Option values do not change after the root file is read, hence they are
+            # only resolved once.
+            if self._resolved_options is None:
+                options = {name: self.get_option_value(name) for name in self.all_options}
+                self._resolved_options = (options, json.dumps(options, sort_keys=True))
+            (options, options_key) = self._resolved_options
 
         cache_dir = os.path.join(self.source_root, ".xbstrap", "cfg_cache")
-        cache_path = os.path.join(cache_dir, cache_name)
-        cached_yml = self._read_cfg_cache(cache_path, refpath, options=options)
-        if cached_yml is not None:
-            return cached_yml
+        ymls = [None] * len(paths)
+        pending = dict()  # Maps memo keys to (indices, refpath, cache_path, load arguments).
+        for i, path in enumerate(paths):
+            # Determine the extension of the config file.
+            ext = None
+            for candidate in [".y4.yml", ".yml"]:
+                if path.endswith(candidate):
+                    ext = candidate
+                    break
+            if ext is None:
+                raise GenericError(f"Config file {path} has no recognized extension")
+            noext_path = path.removesuffix(ext)
+
+            # The same file can be imported multiple times (e.g., with different filters).
+            # Avoid re-reading it as long as it did not change.
+            refpath = os.path.realpath(path)
+            file_stat = os.stat(refpath)
+            memo_key = (refpath, file_stat.st_mtime_ns, file_stat.st_size, options_key)
+            memo_yml = _yml_memo.get(memo_key)
+            if memo_yml is not None:
+                ymls[i] = memo_yml
+                continue
+            if memo_key in pending:
+                pending[memo_key][0].append(i)
+                continue
 
-        if ext == ".y4.yml":
-            assert not is_root
+            # Try to read the cached file.
+            cache_path = os.path.join(cache_dir, _cfg_cache_name(refpath))
+            cached_yml = self._read_cfg_cache(cache_path, refpath, options=options)
+            if cached_yml is not None:
+                cached_yml = _intern_yml_keys(cached_yml)
+                _yml_memo[memo_key] = cached_yml
+                ymls[i] = cached_yml
+                continue
 
-            y4_args = ["y4"]
+            y4_args = None
+            if ext == ".y4.yml":
+                assert not is_root
 
-            # Make options available through !std::opt.
-            for k, v in options.items():
-                y4_args.extend(["--opt", k, v])
+                y4_args = ["y4"]
 
-            # Allow custom modules to be loaded from y4.d.
-            y4d = os.path.join(self.source_root, "y4.d")
-            if os.path.exists(y4d):
-                y4_args.extend(["-p", y4d])
+                # Make options available through !std::opt.
+                for k, v in options.items():
+                    y4_args.extend(["--opt", k, v])
 
-            y4_args.append(path)  # Final argument: path to yaml file.
+                # Allow custom modules to be loaded from y4.d.
+                y4d = os.path.join(self.source_root, "y4.d")
+                if os.path.exists(y4d):
+                    y4_args.extend(["-p", y4d])
 
-            y4_result = subprocess.run(
+                y4_args.append(path)  # Final argument: path to yaml file.
+
+            load_args = (
+                path,
                 y4_args,
-                stdout=subprocess.PIPE,
-                encoding="utf-8",
+                noext_path + ".out.yml" if self.debug_cfg_files else None,
+                None if self.ignore_cfg_cache else cache_dir,
             )
-            if y4_result.returncode != 0:
-                raise GenericError(f"y4 invocation failed: {y4_args}")
-
-            y4_out = y4_result.stdout
-            if self.debug_cfg_files:
-                with open(noext_path + ".out.yml", "w") as f:
-                    f.write(y4_out)
-            yml = yaml.load(y4_out, Loader=global_yaml_loader)
+            pending[memo_key] = ([i], refpath, cache_path, load_args)
+
+        if len(pending) < 2:
+            results = [_load_cfg_file(*load_args) for (*_, load_args) in pending.values()]
         else:
-            # Handle plain old YAML files.
-            with open(path, "r") as f:
-                yml = yaml.load(f, Loader=global_yaml_loader)
-
-        yml_valid = validate_bootstrap_yaml(yml, path)
-
-        # Write the cache only if there are no warnings during validation.
-        if yml_valid:
-            cache_dict = {
-                "refpath": refpath,
-                "yml": yml,
-                "options": options,
-            }
-            _util.try_mkdir(cache_dir, recursive=True)
-            with tempfile.NamedTemporaryFile("w+", dir=cache_dir, delete=False) as temp_f:
-                json.dump(cache_dict, temp_f)
-            os.rename(temp_f.name, cache_path)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(len(pending), get_concurrency())
+            ) as executor:
+                futures = [
+                    executor.submit(_load_cfg_file, *load_args)
+                    for (*_, load_args) in pending.values()
+                ]
+            results = [future.result() for future in futures]
+
+        # Report validation errors here (and not in the workers) such that they are
+        # printed in import order.
+        for memo_key, (yml, yml_errors) in zip(pending, results):
+            (indices, refpath, cache_path, _) = pending[memo_key]
+            _report_validation_errors(yml_errors)
+            yml = _intern_yml_keys(yml)
+            # Write the cache only if there are no warnings during validation.
+            if not yml_errors:
+                cache_header = {
+                    "refpath": refpath,
+                    "schema": get_schema_fingerprint(),
+                    "options": options,
+                }
+                _util.try_mkdir(cache_dir, recursive=True)
+                # marshal is much faster to load than JSON. Unlike pickle, it only supports
+                # plain data and never runs code while loading (the cache lives in the source
+                # tree and hence cannot be fully trusted).
+                # The header is stored separately such that _read_cfg_cache() can reject
+                # stale caches without loading the (potentially large) YAML tree.
+                with tempfile.NamedTemporaryFile("wb", dir=cache_dir, delete=False) as temp_f:
+                    try:
+                        marshal.dump(cache_header, temp_f)
+                        marshal.dump(yml, temp_f)
+                    except ValueError:
+                        # The YAML tree contains objects that marshal does not support
+                        # (e.g., timestamps). Do not cache the file.
+                        cache_path = None
+                if cache_path is None:
+                    os.unlink(temp_f.name)
+                else:
+                    os.rename(temp_f.name, cache_path)
 
-        return yml
+            _yml_memo[memo_key] = yml
+            for i in indices:
+                ymls[i] = yml
+        return ymls
 
     def _read_cfg_cache(self, cache_path, refpath, *, options):
         if self.ignore_cfg_cache:
             return None
 
         try:
-            with open(cache_path) as f:
+            with open(cache_path, "rb") as f:
                 stat = os.fstat(f.fileno())
                 if stat_mtime(refpath) > stat.st_mtime:
                     if verbosity:
                         _util.log_info(f"Cache for {refpath} is out of date")
                     return None
-                cache = json.load(f)
+                cache_header = marshal.load(f)
+
+                if cache_header["refpath"] != refpath:
+                    if verbosity:
+                        _util.log_info(f"Cache path mismatch for {refpath}")
+                    return None
+                if cache_header["options"] != options:
+                    if verbosity:
+                        _util.log_info(f"Cache for {refpath} was built with different options")
+                    return None
+                if cache_header["schema"] != get_schema_fingerprint():
+                    if verbosity:
+                        _util.log_info(
+                            f"Cache for {refpath} was validated against a different schema"
+                        )
+                    return None
+
+                yml = marshal.load(f)
         except FileNotFoundError:
             if verbosity:
                 _util.log_info(f"No cache for {refpath}")
             return None
-
-        if cache["refpath"] != refpath:
-            if verbosity:
-                _util.log_info(f"Cache path mismatch for {refpath}")
-            return None
-        if cache["options"] != options:
+        except (EOFError, ValueError, TypeError, KeyError):
             if verbosity:
-                _util.log_info(f"Cache for {refpath} was built with different options")
+                _util.log_info(f"Cache for {refpath} is corrupted")
             return None
 
         if verbosity:
             _util.log_info(f"Found valid cache for {refpath}")
-        return cache["yml"]
+        return yml
 
     def _parse_yml(
         self,
@@ -426,25 +788,34 @@ class Config:
         if "imports" in current_yml and isinstance(current_yml["imports"], list):
             if current_yml is not self._root_yml:
                 raise GenericError("Nested imports are not supported")
+            import_paths = []
             for import_def in current_yml["imports"]:
                 if "from" not in import_def and "file" not in import_def:
                     raise GenericError("Unexpected data in import")
                 elif "from" in import_def and "file" in import_def:
                     raise GenericError("Unexpected data in import")
+                import_paths.append(
+                    os.path.join(
+                        os.path.dirname(current_path),
+                        str(import_def["from"] if "from" in import_def else import_def["file"]),
+                    )
+                )
 
+            # Read all imports at once such that they can be parsed in parallel.
+            import_ymls = self._read_ymls(import_paths, is_root=False)
+
+            for import_def, import_path, import_yml in zip(
+                current_yml["imports"], import_paths, import_ymls
+            ):
                 if "from" in import_def:
-                    import_path = os.path.join(
-                        os.path.dirname(current_path), str(import_def["from"])
-                    )
                     filter = dict()
-                    import_yml = self._read_yml(import_path, is_root=False)
                     for f in ["sources", "tools", "packages", "tasks"]:
                         if "all_" + f in import_def:
                             filter[f] = None
                         elif f in import_def:
-                            filter[f] = import_def[f]
+                            filter[f] = frozenset(import_def[f])
                         else:
-                            filter[f] = []
+                            filter[f] = frozenset()
                     self._parse_yml(
                         import_path,
                         import_yml,
@@ -453,11 +824,7 @@ class Config:
                         filter_pkgs=filter["packages"],
                         filter_tasks=filter["tasks"],
                     )
-                elif "file" in import_def:
-                    import_path = os.path.join(
-                        os.path.dirname(current_path), str(import_def["file"])
-                    )
-                    import_yml = self._read_yml(import_path, is_root=False)
+                else:
                     self._parse_yml(import_path, import_yml)
 
         if "sources" in current_yml and isinstance(current_yml["sources"], list):
@@ -480,6 +847,9 @@ class Config:
                 if not (filter_tools is None) and (pkg.name not in filter_tools):
                     continue
                 self._tool_pkgs[pkg.name] = pkg
+                arch = pkg.architecture
+                if arch != "noarch":
+                    self._site_archs.add(arch)
 
         if "packages" in current_yml and isinstance(current_yml["packages"], list):
             for pkg_yml in current_yml["packages"]:
@@ -492,6 +862,9 @@ class Config:
                 if not (filter_pkgs is None) and (pkg.name not in filter_pkgs):
                     continue
                 self._target_pkgs[pkg.name] = pkg
+                arch = pkg.architecture
+                if arch != "noarch":
+                    self._site_archs.add(arch)
 
         if "tasks" in current_yml and isinstance(current_yml["tasks"], list):
             for task_yml in current_yml["tasks"]:
@@ -502,6 +875,10 @@ class Config:
                     continue
                 self._tasks[task.name] = task
 
+    @property
+    def sentinel_cache(self):
+        return self._sentinel_cache
+
     @property
     def patch_author(self):
         default = "xbstrap"
@@ -561,6 +938,10 @@ class Config:
     def auto_pull(self):
         return self._site_yml.get("auto_pull", False)
 
+    @property
+    def incremental_configure(self):
+        return self._site_yml.get("incremental_configure", False)
+
     @property
     def use_xbps(self):
         if "pkg_management" not in self._site_yml:
@@ -581,104 +962,60 @@ class Config:
 
     @property
     def build_root(self):
-        return self._build_root_override or os.getcwd()
+        return self._build_root
 
-    @property
+    @functools.cached_property
+    def _directories_yml(self):
+        return self._root_yml.get("directories", dict())
+
+    @functools.cached_property
     def sysroot_subdir(self):
-        if (
-            "directories" not in self._root_yml
-            or "system_root" not in self._root_yml["directories"]
-        ):
-            return "system-root"
-        else:
-            return self._root_yml["directories"]["system_root"]
+        return self._directories_yml.get("system_root", "system-root")
 
     # sysroot_dir = build_root + sysroot_subdir
-    @property
+    @functools.cached_property
     def sysroot_dir(self):
-        if (
-            "directories" not in self._root_yml
-            or "system_root" not in self._root_yml["directories"]
-        ):
-            return os.path.join(self.build_root, "system-root")
-        else:
-            return os.path.join(self.build_root, self._root_yml["directories"]["system_root"])
+        return os.path.join(self.build_root, self.sysroot_subdir)
 
-    @property
+    @functools.cached_property
     def xbps_repository_dir(self):
         return os.path.join(self.build_root, "xbps-repo")
 
-    @property
+    @functools.cached_property
     def tool_build_subdir(self):
-        if (
-            "directories" not in self._root_yml
-            or "pkg_builds" not in self._root_yml["directories"]
-        ):
-            return "tool-builds"
-        else:
-            return self._root_yml["directories"]["tool_builds"]
+        return self._directories_yml.get("tool_builds", "tool-builds")
 
     # tool_build_dir = build_root + tool_build_subdir.
-    @property
+    @functools.cached_property
     def tool_build_dir(self):
-        if (
-            "directories" not in self._root_yml
-            or "pkg_builds" not in self._root_yml["directories"]
-        ):
-            return os.path.join(self.build_root, "tool-builds")
-        else:
-            return os.path.join(self.build_root, self._root_yml["directories"]["tool_builds"])
+        return os.path.join(self.build_root, self.tool_build_subdir)
 
-    @property
+    @functools.cached_property
     def pkg_build_subdir(self):
-        if (
-            "directories" not in self._root_yml
-            or "pkg_builds" not in self._root_yml["directories"]
-        ):
-            return "pkg-builds"
-        else:
-            return self._root_yml["directories"]["pkg_builds"]
+        return self._directories_yml.get("pkg_builds", "pkg-builds")
 
     # pkg_build_dir = build_root + pkg_build_subdir.
-    @property
+    @functools.cached_property
     def pkg_build_dir(self):
-        if (
-            "directories" not in self._root_yml
-            or "pkg_builds" not in self._root_yml["directories"]
-        ):
-            return os.path.join(self.build_root, "pkg-builds")
-        else:
-            return os.path.join(self.build_root, self._root_yml["directories"]["pkg_builds"])
+        return os.path.join(self.build_root, self.pkg_build_subdir)
 
-    @property
+    @functools.cached_property
     def tool_out_subdir(self):
-        if "directories" not in self._root_yml or "tools" not in self._root_yml["directories"]:
-            return "tools"
-        else:
-            return self._root_yml["directories"]["tools"]
+        return self._directories_yml.get("tools", "tools")
 
     # tool_out_dir = build_root + tool_out_subdir
-    @property
+    @functools.cached_property
     def tool_out_dir(self):
-        if "directories" not in self._root_yml or "tools" not in self._root_yml["directories"]:
-            return os.path.join(self.build_root, "tools")
-        else:
-            return os.path.join(self.build_root, self._root_yml["directories"]["tools"])
+        return os.path.join(self.build_root, self.tool_out_subdir)
 
-    @property
+    @functools.cached_property
     def package_out_subdir(self):
-        if "directories" not in self._root_yml or "packages" not in self._root_yml["directories"]:
-            return "packages"
-        else:
-            return self._root_yml["directories"]["packages"]
+        return self._directories_yml.get("packages", "packages")
 
     # package_out_dir = build_root + package_out_subdir
-    @property
+    @functools.cached_property
     def package_out_dir(self):
-        if "directories" not in self._root_yml or "packages" not in self._root_yml["directories"]:
-            return os.path.join(self.build_root, "packages")
-        else:
-            return os.path.join(self.build_root, self._root_yml["directories"]["packages"])
+        return os.path.join(self.build_root, self.package_out_subdir)
 
     @property
     def cargo_config_toml(self):
@@ -694,11 +1031,12 @@ class Config:
             yield yml["name"]
 
     def get_option_value(self, name):
-        decl = None
-        for yml in self._root_yml.get("declare_options", []):
-            if yml["name"] == name:
-                assert not decl
-                decl = yml
+        if self._option_decls is None:
+            self._option_decls = dict()
+            for yml in self._root_yml.get("declare_options", []):
+                assert yml["name"] not in self._option_decls
+                self._option_decls[yml["name"]] = yml
+        decl = self._option_decls.get(name)
         if not decl:
             raise KeyError()
 
@@ -708,16 +1046,22 @@ class Config:
         else:
             return decl.get("default", None)
 
-    def check_labels(self, s):
+    # Tuple (match, ban) of label sets from bootstrap-site.yml. match is None if not given.
+    @functools.cached_property
+    def _label_filter(self):
         label_yml = self._site_yml.get("labels", dict())
-
+        match = None
         if "match" in label_yml:
-            match_list = label_yml["match"]
-            if not any(x in s for x in match_list):
-                return False
+            match = frozenset(label_yml["match"])
+        return (match, frozenset(label_yml.get("ban", [])))
+
+    def check_labels(self, s):
+        (match, ban) = self._label_filter
+
+        if match is not None and match.isdisjoint(s):
+            return False
 
-        ban_list = label_yml.get("ban", [])
-        if any(x in s for x in ban_list):
+        if not ban.isdisjoint(s):
             return False
 
         return True
@@ -726,19 +1070,18 @@ class Config:
         return self._sources[name]
 
     def get_tool_pkg(self, name):
-        if name in self._tool_pkgs:
-            tool = self._tool_pkgs[name]
-            if not self.check_labels(tool.label_set):
-                raise GenericError(f"Tool {name} does not match label configuration")
-            return tool
-        else:
+        tool = self._tool_pkgs.get(name)
+        if tool is None:
             raise GenericError(f"Unknown tool {name}")
+        if not self.check_labels(tool.label_set):
+            raise GenericError(f"Tool {name} does not match label configuration")
+        return tool
 
     def get_task(self, name):
-        if name in self._tasks:
-            return self._tasks[name]
-        else:
+        task = self._tasks.get(name)
+        if task is None:
             raise GenericError(f"Unknown task {name}")
+        return task
 
     def all_sources(self):
         yield from self._sources.values()
@@ -756,14 +1099,12 @@ class Config:
             yield pkg
 
     def get_target_pkg(self, name):
-        if name in self._target_pkgs:
-            pkg = self._target_pkgs[name]
-            if not self.check_labels(pkg.label_set):
-                raise GenericError(f"Package {name} does not match label configuration")
-            return pkg
-        else:
-            raise GenericError(f"Unknown package {name}")
+        pkg = self._target_pkgs.get(name)
+        if pkg is None:
             raise GenericError(f"Unknown package {name}")
+        if not self.check_labels(pkg.label_set):
+            raise GenericError(f"Package {name} does not match label configuration")
+        return pkg
 
     def get_xbps_url(self, arch):
         xbps_yml = self._root_yml["repositories"]["xbps"]
@@ -775,21 +1116,24 @@ class Config:
             raise RuntimeError("xbps repo specification must be dict or string")
 
     def download_remote_xbps_repodata(self, arch):
-        index = self._cached_repodata.get(arch)
-        if index is not None:
-            return index
+        # With --jobs, multiple items can ask for the repodata at the same time.
+        # Hold the lock while downloading such that the file is only downloaded once.
+        with self._repodata_lock:
+            index = self._cached_repodata.get(arch)
+            if index is not None:
+                return index
 
-        _util.try_mkdir(self.xbps_repository_dir)
+            _util.try_mkdir(self.xbps_repository_dir)
 
-        repo_url = self.get_xbps_url(arch)
-        rd_path = os.path.join(self.xbps_repository_dir, f"remote-{arch}-repodata")
-        rd_url = urllib.parse.urljoin(repo_url + "/", f"{arch}-repodata")
-        _util.log_info(f"Downloading {arch}-repodata from {repo_url}")
-        _util.interactive_download(rd_url, rd_path)
+            repo_url = self.get_xbps_url(arch)
+            rd_path = os.path.join(self.xbps_repository_dir, f"remote-{arch}-repodata")
+            rd_url = urllib.parse.urljoin(repo_url + "/", f"{arch}-repodata")
+            _util.log_info(f"Downloading {arch}-repodata from {repo_url}")
+            _util.interactive_download(rd_url, rd_path)
 
-        index = _xbps_utils.read_repodata(rd_path)
-        self._cached_repodata[arch] = index
-        return index
+            index = _xbps_utils.read_repodata(rd_path)
+            self._cached_repodata[arch] = index
+            return index
 
     def access_local_xbps_repodata(self, arch):
         rd_path = os.path.join(self.xbps_repository_dir, f"{arch}-repodata")
@@ -800,32 +1144,58 @@ class Config:
             return {}
         return index
 
+    # Returns a dict that maps the names of all packages in the sysroot to tuples
+    # (state, pkgver), where state is the xbps state (e.g., "ii" for installed or "uu" for
+    # unpacked) and pkgver is the installed version (e.g., "libexpat-2.5.0_6").
+    # The result is cached per sysroot.
+    def get_xbps_pkg_states(self, sysroot):
+        # Item states are determined concurrently; query each sysroot only once.
+        with self._xbps_pkg_states_lock:
+            states = self._cached_xbps_pkg_states.get(sysroot)
+            if states is not None:
+                return states
+
+            environ = os.environ.copy()
+            _util.build_environ_paths(
+                environ, "PATH", prepend=[os.path.join(_util.find_home(), "bin")]
+            )
+
+            out = subprocess.check_output(
+                ["xbps-query", "-r", sysroot, "-l"],
+                env=environ,
+                stderr=subprocess.DEVNULL,
+                encoding="utf-8",
+            )
+
+            # Lines have a format such as:
+            # "ii linux-headers-6.9.3_1            Linux kernel headers"
+            # "ii libexpat-2.5.0_6                 Stream-oriented XML parser library"
+            states = dict()
+            for line in out.splitlines():
+                # A plain split is enough for this fixed format and cheaper than a regex.
+                fields = line.split(None, 2)
+                if len(fields) < 2:
+                    raise GenericError(f"Unexpected line {repr(line)} from xbps-query")
+                name = fields[1].rsplit("-", maxsplit=1)[0]
+                states[name] = (fields[0], fields[1])
+
+            self._cached_xbps_pkg_states[sysroot] = states
+            return states
+
+    def invalidate_xbps_pkg_states(self, sysroot):
+        with self._xbps_pkg_states_lock:
+            self._cached_xbps_pkg_states.pop(sysroot, None)
+
+    # Drops cached information about the state of the build (e.g., after running a plan).
+    def clear_state_caches(self):
+        self._sentinel_cache.clear()
+        self._cached_xbps_pkg_states.clear()
+
     def get_installed_pkgs(self):
         if not self.use_xbps:
             raise GenericError("Package management configuration cannot query installed packages")
-        environ = os.environ.copy()
-        _util.build_environ_paths(
-            environ, "PATH", prepend=[os.path.join(_util.find_home(), "bin")]
-        )
-
-        out = subprocess.check_output(
-            ["xbps-query", "-r", self.sysroot_dir, "-l"],
-            env=environ,
-            stderr=subprocess.DEVNULL,
-            encoding="utf-8",
-        )
-
-        # Lines have a format such as:
-        # "ii linux-headers-6.9.3_1            Linux kernel headers"
-        # "ii libexpat-2.5.0_6                 Stream-oriented XML parser library"
-        pattern = re.compile(r"^[\w?]+ ([^ ]+) ")
-        for line in out.splitlines():
-            match = pattern.match(line)
-            if not match:
-                raise GenericError(f"Unexpected line {repr(line)} from xbps-query")
-            pkgver = match.group(1)
-            name = pkgver.rsplit("-", maxsplit=1)[0]
 
+        for name in self.get_xbps_pkg_states(self.sysroot_dir):
             pkg = self._target_pkgs.get(name)
             if pkg is None:
                 continue
@@ -885,64 +1255,61 @@ class ScriptStep:
 def traverse_graph(*, roots, visit, key=None):
     seen = set()
     stack = []
+    # Bind these to locals since they are used for every edge.
+    seen_add = seen.add
+    stack_append = stack.append
 
     if key is None:
-        key = lambda n: n
+        # Most callers do not need a key function; avoid calling one per edge.
+        for n in roots:
+            if n not in seen:
+                seen_add(n)
+                stack_append(n)
+        while stack:
+            for n in visit(stack.pop()):
+                if n not in seen:
+                    seen_add(n)
+                    stack_append(n)
+        return
 
     for n in roots:
         k = key(n)
-        if k in seen:
-            continue
-        seen.add(k)
-        stack.append(n)
-
+        if k not in seen:
+            seen_add(k)
+            stack_append(n)
     while stack:
-        c = stack.pop()
-
-        for n in visit(c):
+        for n in visit(stack.pop()):
             k = key(n)
-            if k in seen:
-                continue
-            seen.add(k)
-            stack.append(n)
+            if k not in seen:
+                seen_add(k)
+                stack_append(n)
 
 
 class RequirementsMixin:
     @property
     def source_dependencies(self):
-        sources_seen = set()
-        sources_stack = []
-
-        def visit(source):
-            if source in sources_seen:
-                return
-            sources_seen.add(source)
-            sources_stack.append(source)
-
-        def visit_yml(yml):
+        def source_name(yml):
             if isinstance(yml, dict):
-                this_source = yml["name"]
-            else:
-                assert isinstance(yml, str)
-                this_source = yml
-
-            visit(this_source)
+                return yml["name"]
+            assert isinstance(yml, str)
+            return yml
 
-        # Recursively visit all sources
-        for yml in self._this_yml.get("sources_required", []):
-            visit_yml(yml)
+        # Recursively visit all sources, in the order that they are popped from the stack.
+        sources = []
 
-        while sources_stack:
-            source = sources_stack.pop()
-            assert isinstance(source, str)
-            yield source
+        def visit(source):
+            sources.append(source)
+            return [
+                yml["name"]
+                for yml in self._cfg.get_source(source)._this_yml.get("sources_required", [])
+                if isinstance(yml, dict) and yml.get("recursive", False)
+            ]
 
-            for yml in self._cfg.get_source(source)._this_yml.get("sources_required", []):
-                if not isinstance(yml, dict):
-                    continue
-                if not yml.get("recursive", False):
-                    continue
-                visit_yml(yml)
+        traverse_graph(
+            roots=[source_name(yml) for yml in self._this_yml.get("sources_required", [])],
+            visit=visit,
+        )
+        return sources
 
     @property
     def tool_dependencies(self):
@@ -950,44 +1317,51 @@ class RequirementsMixin:
 
     @property
     def tool_stage_dependencies(self):
-        tools_seen = set()
-        tools_stack = []
+        # The yml is immutable after loading, hence the result can be cached on the subject.
+        deps = getattr(self, "_cached_tool_stage_deps", None)
+        if deps is None:
+            deps = self._discover_tool_stage_dependencies()
+            self._cached_tool_stage_deps = deps
+        return deps
 
-        def visit(stage):
-            if stage.subject_id in tools_seen:
-                return
-            tools_seen.add(stage.subject_id)
-            tools_stack.append(stage)
+    def _discover_tool_stage_dependencies(self):
+        seen = set()
+        queue = collections.deque()
+        deps = []
+
+        def stages_of(yml):
+            if isinstance(yml, str):
+                return self._cfg.get_tool_pkg(yml).all_stages()
+            tool = self._cfg.get_tool_pkg(yml["tool"])
+            if "stage_dependencies" in yml:
+                return [tool.get_stage(stage_name) for stage_name in yml["stage_dependencies"]]
+            return tool.all_stages()
 
         def visit_yml(yml):
-            if isinstance(yml, dict):
-                if "virtual" in yml:
-                    return
-                if "stage_dependencies" in yml:
-                    for stage_name in yml["stage_dependencies"]:
-                        visit(self._cfg.get_tool_pkg(yml["tool"]).get_stage(stage_name))
-                else:
-                    for stage in self._cfg.get_tool_pkg(yml["tool"]).all_stages():
-                        visit(stage)
-            else:
-                assert isinstance(yml, str)
-                for stage in self._cfg.get_tool_pkg(yml).all_stages():
-                    visit(stage)
+            for stage in stages_of(yml):
+                subject_id = stage.subject_id
+                if subject_id in seen:
+                    continue
+                seen.add(subject_id)
+                queue.append(stage)
+                deps.append(subject_id)
 
         for yml in self._this_yml.get("tools_required", []):
+            if isinstance(yml, dict) and "virtual" in yml:
+                continue
             visit_yml(yml)
 
-        while tools_stack:
-            stage = tools_stack.pop()
-            yield stage.subject_id
-
+        while queue:
+            stage = queue.popleft()
             for yml in stage.pkg._this_yml.get("tools_required", []):
                 if not isinstance(yml, dict):
                     continue
-                if not yml.get("recursive", False):
+                if "virtual" in yml or not yml.get("recursive", False):
                     continue
                 visit_yml(yml)
 
+        return tuple(deps)
+
     @property
     def virtual_tools(self):
         if "tools_required" in self._this_yml:
@@ -1022,6 +1396,16 @@ class RequirementsMixin:
                         yield yml["task"]
 
     def resolve_tool_deps(self, *, exposed_only=False):
+        # Like tool_stage_dependencies, this only depends on the (immutable) yml.
+        # Results are cached per value of exposed_only.
+        cached = getattr(self, "_cached_tool_deps", None)
+        if cached is None:
+            cached = dict()
+            self._cached_tool_deps = cached
+        deps = cached.get(exposed_only)
+        if deps is not None:
+            return deps
+
         deps = set()
 
         def visit(subject):
@@ -1049,20 +1433,30 @@ class RequirementsMixin:
                 yield tool
 
         traverse_graph(roots=[self], visit=visit)
+        deps = frozenset(deps)
+        cached[exposed_only] = deps
         return deps
 
     def discover_recursive_pkg_dependencies(self):
+        # Like tool_stage_dependencies, this only depends on the (immutable) yml.
+        deps = getattr(self, "_cached_recursive_pkg_deps", None)
+        if deps is not None:
+            return deps
+
         s = set()
-        stack = [self]
-        while stack:
-            subject = stack.pop()
+        queue = collections.deque([self])
+        while queue:
+            subject = queue.popleft()
 
             for dep_name in subject.pkg_dependencies:
-                dep = self._cfg.get_target_pkg(dep_name)
-                if dep_name not in s:
-                    stack.append(dep)
+                if dep_name in s:
+                    continue
                 s.add(dep_name)
-        return s
+                queue.append(self._cfg.get_target_pkg(dep_name))
+
+        deps = frozenset(s)
+        self._cached_recursive_pkg_deps = deps
+        return deps
 
     def xbps_dependency_string(self):
         deps = ""
@@ -1269,7 +1663,12 @@ class Source(RequirementsMixin):
         yield from self._regenerate_steps
 
     def check_if_fetched(self, settings):
-        s = _vcs_utils.check_repo(self, self.sub_dir, check_remotes=settings.check_remotes)
+        s = _vcs_utils.check_repo(
+            self,
+            self.sub_dir,
+            check_remotes=settings.check_remotes,
+            remote_commits=settings.remote_commits,
+        )
         if s == _vcs_utils.RepoStatus.MISSING:
             return ItemState(missing=True)
         elif s == _vcs_utils.RepoStatus.OUTDATED:
@@ -1278,12 +1677,11 @@ class Source(RequirementsMixin):
             assert s == _vcs_utils.RepoStatus.GOOD
 
         path = os.path.join(self.source_dir, "fetched.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             # This is a special case: we already found that the commit exists.
             return ItemState()
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def check_if_mirrord(self, settings):
         vcs = _vcs_utils.vcs_name(self)
@@ -1292,7 +1690,12 @@ class Source(RequirementsMixin):
             # ignore non-gits for mirroring
             return ItemState()
 
-        s = _vcs_utils.check_repo(self, f"mirror/{vcs}", check_remotes=settings.check_remotes)
+        s = _vcs_utils.check_repo(
+            self,
+            f"mirror/{vcs}",
+            check_remotes=settings.check_remotes,
+            remote_commits=settings.remote_commits,
+        )
         if s == _vcs_utils.RepoStatus.MISSING:
             return ItemState(missing=True)
         elif s == _vcs_utils.RepoStatus.OUTDATED:
@@ -1303,40 +1706,37 @@ class Source(RequirementsMixin):
         return ItemState()
 
     def mark_as_fetched(self):
-        touch(os.path.join(self.source_dir, "fetched.xbstrap"))
+        self._cfg.sentinel_cache.touch(os.path.join(self.source_dir, "fetched.xbstrap"))
 
     def check_if_checkedout(self, settings):
         path = os.path.join(self.source_dir, "checkedout.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_checkedout(self):
-        touch(os.path.join(self.source_dir, "checkedout.xbstrap"))
+        self._cfg.sentinel_cache.touch(os.path.join(self.source_dir, "checkedout.xbstrap"))
 
     def check_if_patched(self, settings):
         path = os.path.join(self.source_dir, "patched.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_patched(self):
-        touch(os.path.join(self.source_dir, "patched.xbstrap"))
+        self._cfg.sentinel_cache.touch(os.path.join(self.source_dir, "patched.xbstrap"))
 
     def check_if_regenerated(self, settings):
         path = os.path.join(self.source_dir, "regenerated.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_regenerated(self):
-        touch(os.path.join(self.source_dir, "regenerated.xbstrap"))
+        self._cfg.sentinel_cache.touch(os.path.join(self.source_dir, "regenerated.xbstrap"))
 
 
 class HostStage(RequirementsMixin):
@@ -1392,17 +1792,17 @@ class HostStage(RequirementsMixin):
         if not self._inherited:
             stage_spec = "@" + self.stage_name
         path = os.path.join(self._pkg.build_dir, "built" + stage_spec + ".xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_compiled(self):
         stage_spec = ""
         if not self._inherited:
             stage_spec = "@" + self.stage_name
-        touch(os.path.join(self._pkg.build_dir, "built" + stage_spec + ".xbstrap"))
+        path = os.path.join(self._pkg.build_dir, "built" + stage_spec + ".xbstrap")
+        self._cfg.sentinel_cache.touch(path)
 
     def check_if_installed(self, settings):
         stage_spec = ""
@@ -1411,29 +1811,34 @@ class HostStage(RequirementsMixin):
         path = os.path.join(
             self._pkg.prefix_dir, "etc", "xbstrap", self._pkg.name + stage_spec + ".installed"
         )
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_installed(self):
         stage_spec = ""
         if not self._inherited:
             stage_spec = "@" + self.stage_name
-        _util.try_mkdir(os.path.join(self._pkg.prefix_dir, "etc"))
-        _util.try_mkdir(os.path.join(self._pkg.prefix_dir, "etc", "xbstrap"))
+        _util.try_mkdir(os.path.join(self._pkg.prefix_dir, "etc", "xbstrap"), recursive=True)
         path = os.path.join(
             self._pkg.prefix_dir, "etc", "xbstrap", self._pkg.name + stage_spec + ".installed"
         )
-        touch(path)
+        self._cfg.sentinel_cache.touch(path)
 
 
 class HostPackage(RequirementsMixin):
     def __init__(self, cfg, pkg_yml):
         self._cfg = cfg
         self._this_yml = pkg_yml
+        self._name = pkg_yml["name"]
+        self._subject_id = SubjectId(SubjectType.TOOL, self._name)
         self._labels = set(pkg_yml.get("labels", []))
+        self._exports_shared_libs = pkg_yml.get("exports_shared_libs", False)
+        self._exports_aclocal = pkg_yml.get("exports_aclocal", False)
+        self._containerless = pkg_yml.get("containerless", False)
+        self._stability_level = pkg_yml.get("stability_level", "stable")
+        self._recursive_tool_pkgs = None
         self._configure_steps = []
         self._stages = dict()
         self._tasks = dict()
@@ -1465,21 +1870,15 @@ class HostPackage(RequirementsMixin):
 
     @property
     def exports_shared_libs(self):
-        if "exports_shared_libs" not in self._this_yml:
-            return False
-        return self._this_yml["exports_shared_libs"]
+        return self._exports_shared_libs
 
     @property
     def exports_aclocal(self):
-        if "exports_aclocal" not in self._this_yml:
-            return False
-        return self._this_yml["exports_aclocal"]
+        return self._exports_aclocal
 
     @property
     def containerless(self):
-        if "containerless" not in self._this_yml:
-            return False
-        return self._this_yml["containerless"]
+        return self._containerless
 
     @property
     def source(self):
@@ -1501,6 +1900,16 @@ class HostPackage(RequirementsMixin):
                     continue
                 yield yml["tool"]
 
+    # Like recursive_tools_required but returns HostPackages. The result is cached
+    # since run_program() walks these edges for every step.
+    @property
+    def recursive_tool_pkgs(self):
+        if self._recursive_tool_pkgs is None:
+            self._recursive_tool_pkgs = tuple(
+                self._cfg.get_tool_pkg(name) for name in self.recursive_tools_required
+            )
+        return self._recursive_tool_pkgs
+
     @property
     def build_subdir(self):
         return os.path.join(self._cfg.tool_build_subdir, self.name)
@@ -1523,11 +1932,11 @@ class HostPackage(RequirementsMixin):
 
     @property
     def name(self):
-        return self._this_yml["name"]
+        return self._name
 
     @property
     def subject_id(self):
-        return SubjectId(SubjectType.TOOL, self.name)
+        return self._subject_id
 
     @property
     def subject_type(self):
@@ -1541,7 +1950,7 @@ class HostPackage(RequirementsMixin):
 
     @property
     def stability_level(self):
-        return self._this_yml.get("stability_level", "stable")
+        return self._stability_level
 
     def all_stages(self):
         yield from self._stages.values()
@@ -1586,17 +1995,17 @@ class HostPackage(RequirementsMixin):
 
     def check_if_configured(self, settings):
         path = os.path.join(self.build_dir, "configured.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_configured(self, mark=True):
+        path = os.path.join(self.build_dir, "configured.xbstrap")
         if mark:
-            touch(os.path.join(self.build_dir, "configured.xbstrap"))
+            self._cfg.sentinel_cache.touch(path)
         else:
-            os.unlink(os.path.join(self.build_dir, "configured.xbstrap"))
+            self._cfg.sentinel_cache.unlink(path)
 
     def check_if_fully_installed(self, settings):
         for stage in self.all_stages():
@@ -1620,7 +2029,11 @@ class TargetPackage(RequirementsMixin):
     def __init__(self, cfg, pkg_yml):
         self._cfg = cfg
         self._this_yml = pkg_yml
+        self._name = pkg_yml["name"]
+        self._subject_id = SubjectId(SubjectType.PKG, self._name)
         self._labels = set(pkg_yml.get("labels", []))
+        self._stability_level = pkg_yml.get("stability_level", "stable")
+        self._is_implicit = pkg_yml.get("implict_package", False)
         self._configure_steps = []
         self._build_steps = []
         self._tasks = dict()
@@ -1680,11 +2093,11 @@ class TargetPackage(RequirementsMixin):
 
     @property
     def name(self):
-        return self._this_yml["name"]
+        return self._name
 
     @property
     def subject_id(self):
-        return SubjectId(SubjectType.PKG, self.name)
+        return self._subject_id
 
     @property
     def subject_type(self):
@@ -1698,13 +2111,11 @@ class TargetPackage(RequirementsMixin):
 
     @property
     def stability_level(self):
-        return self._this_yml.get("stability_level", "stable")
+        return self._stability_level
 
     @property
     def is_implicit(self):
-        if "implict_package" not in self._this_yml:
-            return False
-        return self._this_yml["implict_package"]
+        return self._is_implicit
 
     @property
     def architecture(self):
@@ -1747,17 +2158,17 @@ class TargetPackage(RequirementsMixin):
 
     def check_if_configured(self, settings):
         path = os.path.join(self.build_dir, "configured.xbstrap")
-        try:
-            stat = os.stat(path)
-        except FileNotFoundError:
+        mtime = self._cfg.sentinel_cache.mtime(path)
+        if mtime is None:
             return ItemState(missing=True)
-        return ItemState(timestamp=stat.st_mtime)
+        return ItemState(timestamp=mtime)
 
     def mark_as_configured(self, mark=True):
+        path = os.path.join(self.build_dir, "configured.xbstrap")
         if mark:
-            touch(os.path.join(self.build_dir, "configured.xbstrap"))
+            self._cfg.sentinel_cache.touch(path)
         else:
-            os.unlink(os.path.join(self.build_dir, "configured.xbstrap"))
+            self._cfg.sentinel_cache.unlink(path)
 
     def check_staging(self, settings):
         if not os.access(self.staging_dir, os.F_OK):
@@ -1819,33 +2230,19 @@ class TargetPackage(RequirementsMixin):
 
     def check_if_installed(self, settings, *, sysroot):
         if self._cfg.use_xbps:
-            environ = os.environ.copy()
-            _util.build_environ_paths(
-                environ, "PATH", prepend=[os.path.join(_util.find_home(), "bin")]
-            )
-            environ["XBPS_ARCH"] = self.architecture
-
+            # Query all packages of the sysroot at once instead of running xbps-query per package.
             try:
-                out = subprocess.check_output(
-                    ["xbps-query", "-r", sysroot, self.name],
-                    env=environ,
-                    stderr=subprocess.DEVNULL,
-                )
-                valid_state = False
-                for line in out.splitlines():
-                    if not line.startswith(b"state:"):
-                        continue
-                    if line == b"state: installed" or line == b"state: unpacked":
-                        valid_state = True
-                    break
-                if not valid_state:
-                    return ItemState(missing=True)
-                return ItemState()
+                states = self._cfg.get_xbps_pkg_states(sysroot)
             except subprocess.CalledProcessError:
                 return ItemState(missing=True)
+            # Accept packages that are either installed or unpacked.
+            (state, _) = states.get(self.name, (None, None))
+            if state not in ("ii", "uu"):
+                return ItemState(missing=True)
+            return ItemState()
         else:
             path = os.path.join(sysroot, "etc", "xbstrap", self.name + ".installed")
-            if not os.access(path, os.F_OK):
+            if self._cfg.sentinel_cache.mtime(path) is None:
                 return ItemState(missing=True)
             return ItemState()
 
@@ -1859,10 +2256,9 @@ class TargetPackage(RequirementsMixin):
             return self.check_staging(settings)
 
     def mark_as_installed(self, *, sysroot):
-        _util.try_mkdir(os.path.join(sysroot, "etc"))
-        _util.try_mkdir(os.path.join(sysroot, "etc", "xbstrap"))
+        _util.try_mkdir(os.path.join(sysroot, "etc", "xbstrap"), recursive=True)
         path = os.path.join(sysroot, "etc", "xbstrap", self.name + ".installed")
-        touch(path)
+        self._cfg.sentinel_cache.touch(path)
 
 
 class PackageRunTask(RequirementsMixin):
@@ -1955,56 +2351,77 @@ class RunTask(RequirementsMixin):
             yield ArtifactFile(e["name"], os.path.join(path, e["name"]), architecture)
 
 
+# Directories that contain the wrapper scripts of virtual tools. The scripts of a step only
+# depend on the manifest, so steps that need the same scripts share a directory. Directories
+# are never modified after creation, hence concurrently running steps can use them safely.
+_virtual_bin_lock = threading.Lock()
+_virtual_bin_dirs = dict()  # Maps tuples of (program name, script) pairs to directories.
+_virtual_bin_root = None
+
+
+def _get_virtual_bin(scripts):
+    global _virtual_bin_root
+
+    key = tuple(sorted(scripts.items()))
+    with _virtual_bin_lock:
+        virtual_bin = _virtual_bin_dirs.get(key)
+        if virtual_bin is not None:
+            return virtual_bin
+
+        if _virtual_bin_root is None:
+            _virtual_bin_root = tempfile.mkdtemp(prefix="xbstrap-virtual-")
+            atexit.register(shutil.rmtree, _virtual_bin_root, ignore_errors=True)
+        virtual_bin = os.path.join(_virtual_bin_root, str(len(_virtual_bin_dirs)))
+        os.mkdir(virtual_bin)
+        for name, script in key:
+            # Create the script with its final permissions, no chmod() is required.
+            fd = os.open(
+                os.path.join(virtual_bin, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o775
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(script.encode())
+
+        _virtual_bin_dirs[key] = virtual_bin
+        return virtual_bin
+
+
 def execute_manifest(manifest):
     source_root = manifest["source_root"]
     build_root = manifest["build_root"]
     sysroot_dir = os.path.join(manifest["build_root"], manifest["sysroot_subdir"])
 
-    def substitute(varname):
-        if varname == "SOURCE_ROOT":
-            return source_root
-        elif varname == "BUILD_ROOT":
-            return build_root
-        elif varname == "SYSROOT_DIR":
-            return sysroot_dir
-        elif varname == "PARALLELISM":
-            nthreads = get_concurrency()
-            return str(nthreads)
-        elif varname.startswith("OPTION:"):
-            return manifest["option_values"][varname[7:]]
+    # All variables are known up front, so build a dict instead of resolving them on demand.
+    substitute = {
+        "SOURCE_ROOT": source_root,
+        "BUILD_ROOT": build_root,
+        "SYSROOT_DIR": sysroot_dir,
+        "PARALLELISM": str(get_concurrency()),
+    }
+    for name, value in manifest["option_values"].items():
+        substitute["OPTION:" + name] = value
 
-        if manifest["context"] == "source":
-            if varname == "THIS_SOURCE_DIR":
-                return os.path.join(source_root, manifest["subject"]["source_subdir"])
-        elif (
-            manifest["context"] == "tool"
-            or manifest["context"] == "tool-stage"
-            or manifest["context"] == "tool-task"
-        ):
-            if varname == "THIS_SOURCE_DIR":
-                return os.path.join(source_root, manifest["subject"]["source_subdir"])
-            elif varname == "THIS_BUILD_DIR":
-                return os.path.join(build_root, manifest["subject"]["build_subdir"])
-            elif varname == "PREFIX":
-                return os.path.join(build_root, manifest["subject"]["prefix_subdir"])
-        elif manifest["context"] == "pkg" or manifest["context"] == "pkg-task":
-            if varname == "THIS_SOURCE_DIR":
-                return os.path.join(source_root, manifest["subject"]["source_subdir"])
-            elif varname == "THIS_BUILD_DIR":
-                return os.path.join(build_root, manifest["subject"]["build_subdir"])
-            elif varname == "THIS_COLLECT_DIR":
-                return os.path.join(build_root, manifest["subject"]["collect_subdir"])
+    context = manifest["context"]
+    if context in ("source", "tool", "tool-stage", "tool-task", "pkg", "pkg-task"):
+        substitute["THIS_SOURCE_DIR"] = os.path.join(
+            source_root, manifest["subject"]["source_subdir"]
+        )
+    if context in ("tool", "tool-stage", "tool-task", "pkg", "pkg-task"):
+        substitute["THIS_BUILD_DIR"] = os.path.join(
+            build_root, manifest["subject"]["build_subdir"]
+        )
+    if context in ("tool", "tool-stage", "tool-task"):
+        substitute["PREFIX"] = os.path.join(build_root, manifest["subject"]["prefix_subdir"])
+    elif context in ("pkg", "pkg-task"):
+        substitute["THIS_COLLECT_DIR"] = os.path.join(
+            build_root, manifest["subject"]["collect_subdir"]
+        )
 
     # /bin directory for virtual tools.
     explicit_pkgconfig = False
-    virtual_bin = "/tmp/xbstrap/virtual/bin"
-
-    try_rmtree(virtual_bin)
-    os.makedirs(virtual_bin)
+    scripts = dict()  # Maps program names to scripts.
 
     for yml in manifest["virtual_tools"]:
         if yml["virtual"] == "pkgconfig-for-host":
-            vscript = os.path.join(virtual_bin, yml["program_name"])
             paths = []
             for tool_yml in manifest["tools"]:
                 paths.append(os.path.join(build_root, tool_yml["prefix_subdir"], "lib/pkgconfig"))
@@ -2024,33 +2441,28 @@ def execute_manifest(manifest):
             if os.uname().sysname == "Linux":
                 paths.append("/usr/lib/" + os.uname().machine + "-linux-gnu/pkgconfig")
 
-            with open(vscript, "wt") as f:
-                f.write(
-                    "#!/bin/sh\n"
-                    + "PKG_CONFIG_PATH="
-                    + shlex.quote(":".join(paths))
-                    + ' exec pkg-config "$@"\n'
-                )
-            os.chmod(vscript, 0o775)
+            scripts[yml["program_name"]] = (
+                "#!/bin/sh\n"
+                + "PKG_CONFIG_PATH="
+                + shlex.quote(":".join(paths))
+                + ' exec pkg-config "$@"\n'
+            )
             explicit_pkgconfig = True
         elif yml["virtual"] == "pkgconfig-for-target":
-            vscript = os.path.join(
-                virtual_bin, "{}-pkg-config".format(replace_at_vars(yml["triple"], substitute))
+            scripts["{}-pkg-config".format(replace_at_vars(yml["triple"], substitute))] = (
+                "#!/bin/sh\n"
+                + "PKG_CONFIG_PATH= "
+                + ' PKG_CONFIG_SYSROOT_DIR="${XBSTRAP_SYSROOT_DIR}"'
+                + ' PKG_CONFIG_LIBDIR="${XBSTRAP_SYSROOT_DIR}/usr/lib/pkgconfig'
+                + ':${XBSTRAP_SYSROOT_DIR}/usr/share/pkgconfig"'
+                + ' exec pkg-config "$@"\n'
             )
-            with open(vscript, "wt") as f:
-                f.write(
-                    "#!/bin/sh\n"
-                    + "PKG_CONFIG_PATH= "
-                    + ' PKG_CONFIG_SYSROOT_DIR="${XBSTRAP_SYSROOT_DIR}"'
-                    + ' PKG_CONFIG_LIBDIR="${XBSTRAP_SYSROOT_DIR}/usr/lib/pkgconfig'
-                    + ':${XBSTRAP_SYSROOT_DIR}/usr/share/pkgconfig"'
-                    + ' exec pkg-config "$@"\n'
-                )
-            os.chmod(vscript, 0o775)
             explicit_pkgconfig = True
         else:
             raise GenericError("Unknown virtual tool {}".format(yml["virtual"]))
 
+    virtual_bin = _get_virtual_bin(scripts)
+
     # Determine the arguments.
     if isinstance(manifest["args"], list):
         args = [replace_at_vars(arg, substitute) for arg in manifest["args"]]
@@ -2127,6 +2539,10 @@ def execute_manifest(manifest):
     subprocess.check_call(args, env=environ, cwd=workdir, stdout=output, stderr=output)
 
 
+# Distinguishes runc containers of concurrently running steps.
+_runc_container_serial = itertools.count()
+
+
 def run_program(
     cfg,
     context,
@@ -2162,16 +2578,13 @@ def run_program(
         pkg_queue.append(pkg)
         pkg_visited.add(pkg.name)
 
-    i = 0  # Need index-based loop as pkg_queue is mutated in the loop.
-    while i < len(pkg_queue):
-        pkg = pkg_queue[i]
-        for dep_name in pkg.recursive_tools_required:
-            if dep_name in pkg_visited:
+    # Note that pkg_queue is extended while we iterate over it.
+    for pkg in pkg_queue:
+        for dep_pkg in pkg.recursive_tool_pkgs:
+            if dep_pkg.name in pkg_visited:
                 continue
-            dep_pkg = cfg.get_tool_pkg(dep_name)
             pkg_queue.append(dep_pkg)
-            pkg_visited.add(dep_name)
-        i += 1
+            pkg_visited.add(dep_pkg.name)
 
     manifest = {
         "context": context,
@@ -2382,11 +2795,16 @@ def run_program(
                 },
             }
 
+            # runc requires container IDs to be unique among running containers.
+            container_id = "{}-{}-{}".format(
+                container_yml["id"], os.getpid(), next(_runc_container_serial)
+            )
+
             with tempfile.TemporaryDirectory() as bundle_dir:
                 with open(os.path.join(bundle_dir, "config.json"), "w") as f:
                     json.dump(config_json, f)
 
-                proc = subprocess.Popen(["runc", "run", "-b", bundle_dir, container_yml["id"]])
+                proc = subprocess.Popen(["runc", "run", "-b", bundle_dir, container_id])
                 proc.wait()
                 if proc.returncode != 0:
                     raise ProgramFailureError()
@@ -2483,19 +2901,24 @@ def run_step(
 
 
 def postprocess_libtool(cfg, pkg):
+    removed = []
     for libdir in ["lib", "lib64", "lib32", "usr/lib", "usr/lib64", "usr/lib32"]:
-        filelist = []
         try:
-            filelist = os.listdir(os.path.join(pkg.collect_dir, libdir))
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise
+            with os.scandir(os.path.join(pkg.collect_dir, libdir)) as it:
+                entries = [
+                    entry
+                    for entry in it
+                    if entry.name.endswith(".la") and not entry.is_dir(follow_symlinks=False)
+                ]
+        except FileNotFoundError:
+            continue
 
-        for ent in filelist:
-            if not ent.endswith(".la"):
-                continue
-            _util.log_info("Removed libtool file {}".format(ent))
-            os.unlink(os.path.join(pkg.collect_dir, libdir, ent))
+        for entry in entries:
+            os.unlink(entry.path)
+            removed.append(entry.name)
+
+    if removed:
+        _util.log_info("Removed libtool files {}".format(", ".join(removed)))
 
 
 # ---------------------------------------------------------------------------------------
@@ -2552,6 +2975,8 @@ def checkout_src(cfg, src, settings):
             else:
                 if fixed_commit is not None:
                     commit = fixed_commit
+            if not init and settings.reset == ResetMode.HARD_RESET:
+                subprocess.check_call(["git", "reset", "--hard"], cwd=src.source_dir)
             if init or settings.reset != ResetMode.NONE:
                 subprocess.check_call(
                     ["git", "checkout", "--no-track", "-B", source["branch"], commit],
@@ -2590,18 +3015,40 @@ def checkout_src(cfg, src, settings):
         else:
             assert src.source_archive_format.startswith("tar.")
 
-            compression = {"tar.gz": "gz", "tar.xz": "xz", "tar.bz2": "bz2"}
-            with tarfile.open(
-                src.source_archive_file, "r:" + compression[src.source_archive_format]
-            ) as tar:
-                for info in tar:
-                    if "extract_path" not in source:
-                        prefix = ""
-                    else:
-                        prefix = source["extract_path"] + "/"
-                    if info.name.startswith(prefix):
-                        info.name = src.name + "/" + info.name[len(prefix) :]
-                        tar.extract(info, src.sub_dir)
+            if "extract_path" not in source:
+                prefix = ""
+            else:
+                prefix = source["extract_path"] + "/"
+
+            # GNU tar runs an external program to decompress the archive;
+            # fall back to tarfile if that program is not available.
+            decompressor = {"tar.gz": "gzip", "tar.xz": "xz", "tar.bz2": "bzip2"}.get(
+                src.source_archive_format
+            )
+            gnu_tar = find_gnu_tar()
+            if gnu_tar is not None and (decompressor is None or shutil.which(decompressor)):
+                # Let tar do the renaming. Note that the S flag excludes symlink targets.
+                args = [
+                    gnu_tar,
+                    "-xf",
+                    src.source_archive_file,
+                    "-C",
+                    src.sub_dir,
+                    "--transform",
+                    "s,^{},{}/,S".format(_escape_bre(prefix), _escape_sed_repl(src.name)),
+                ]
+                if prefix:
+                    args.extend(["--wildcards", _escape_glob(prefix) + "*"])
+                subprocess.check_call(args)
+            else:
+                compression = {"tar.gz": "gz", "tar.xz": "xz", "tar.bz2": "bz2"}
+                with tarfile.open(
+                    src.source_archive_file, "r:" + compression[src.source_archive_format]
+                ) as tar:
+                    for info in tar:
+                        if info.name.startswith(prefix):
+                            info.name = src.name + "/" + info.name[len(prefix) :]
+                            tar.extract(info, src.sub_dir)
     else:
         # VCS-less sources.
         pass
@@ -2673,7 +3120,103 @@ def regenerate_src(cfg, src):
 # ---------------------------------------------------------------------------------------
 
 
-def configure_tool(cfg, pkg):
+# Returns a value that identifies the installation of a package in the sysroot.
+# With xbps, the pkgver does not change if a package is rebuilt; hence, this also
+# includes the digest of the package in the local repository.
+def _installed_pkg_stamp(cfg, name, sysroot):
+    if cfg.use_xbps:
+        try:
+            states = cfg.get_xbps_pkg_states(sysroot)
+        except subprocess.CalledProcessError:
+            return None
+        (_, pkgver) = states.get(name, (None, None))
+        rd = cfg.get_target_pkg(name).get_local_xbps_repodata_entry()
+        return [pkgver, rd.get("filename-sha256") if rd is not None else None]
+    else:
+        path = os.path.join(sysroot, "etc", "xbstrap", name + ".installed")
+        return cfg.sentinel_cache.mtime(path)
+
+
+# Returns a stamp that changes whenever the inputs of the configure steps change, i.e.,
+# the configure steps themselves (and the options that they may refer to), the installed tools,
+# the packages installed into the sysroot and the source directory. Note that for the source
+# directory, this only considers the top-level entries (walking the entire tree would defeat
+# the purpose of the stamp).
+def _configure_stamp(cfg, pkg, *, sysroot):
+    src = cfg.get_source(pkg.source)
+    source_mtime = os.stat(src.source_dir).st_mtime_ns
+    with os.scandir(src.source_dir) as it:
+        for entry in it:
+            source_mtime = max(source_mtime, entry.stat(follow_symlinks=False).st_mtime_ns)
+
+    tool_mtimes = dict()
+    for dep_name in map(name_from_subject_id, pkg.resolve_tool_deps(exposed_only=True)):
+        for stage in cfg.get_tool_pkg(dep_name).all_stages():
+            state = stage.check_if_installed(None)
+            tool_mtimes[stringify_subject_id(stage.subject_id)] = state.timestamp
+
+    # Tools are configured without a sysroot.
+    pkg_installs = dict()
+    if sysroot is not None:
+        for dep_name in pkg.discover_recursive_pkg_dependencies():
+            pkg_installs[dep_name] = _installed_pkg_stamp(cfg, dep_name, sysroot)
+
+    return json.dumps(
+        {
+            "source": source_mtime,
+            "tools": tool_mtimes,
+            "pkgs": pkg_installs,
+            "configure": pkg._this_yml.get("configure", []),
+            "options": {name: cfg.get_option_value(name) for name in cfg.all_options},
+        },
+        sort_keys=True,
+    )
+
+
+def _configure_stamp_path(pkg):
+    return os.path.join(pkg.build_dir, "configured-source.xbstrap")
+
+
+# With incremental_configure, an existing build directory is kept if none of the inputs of
+# the configure steps changed since it was configured (see _configure_stamp()).
+# Returns true if the configuration was kept.
+def _try_keep_configuration(cfg, pkg, *, sysroot=None):
+    if not cfg.incremental_configure:
+        return False
+    if cfg.sentinel_cache.mtime(os.path.join(pkg.build_dir, "configured.xbstrap")) is None:
+        return False
+    try:
+        with open(_configure_stamp_path(pkg)) as f:
+            stamp = f.read()
+    except FileNotFoundError:
+        return False
+    if stamp != _configure_stamp(cfg, pkg, sysroot=sysroot):
+        return False
+    _util.log_info(f"Inputs of {pkg.name} are unchanged, keeping existing configuration")
+    # Mark the configuration as up-to-date, otherwise it would be considered outdated again.
+    pkg.mark_as_configured()
+    return True
+
+
+def _write_configure_stamp(cfg, pkg, *, sysroot=None):
+    if not cfg.incremental_configure:
+        return
+    with open(_configure_stamp_path(pkg), "w") as f:
+        f.write(_configure_stamp(cfg, pkg, sysroot=sysroot))
+
+
+# Explicitly requested (e.g., by xbstrap configure or --reconfigure) or reset items
+# are always configured from scratch.
+def _may_keep_configuration(item):
+    if item.settings.reset != ResetMode.NONE:
+        return False
+    return (item.action, item.subject) not in item.plan.wanted
+
+
+def configure_tool(cfg, pkg, *, keep_configuration=False):
+    if keep_configuration and _try_keep_configuration(cfg, pkg):
+        return
+
     try_rmtree(pkg.build_dir)
     _util.try_mkdir(pkg.build_dir, True)
 
@@ -2685,6 +3228,7 @@ def configure_tool(cfg, pkg):
         run_step(cfg, "tool", pkg, step, tool_pkgs, pkg.virtual_tools)
 
     pkg.mark_as_configured()
+    _write_configure_stamp(cfg, pkg)
 
 
 def compile_tool_stage(cfg, stage):
@@ -2738,10 +3282,72 @@ def install_tool_stage(cfg, stage):
     stage.mark_as_installed()
 
 
+# Returns the path of GNU tar (or None if tar is not GNU tar).
+@functools.lru_cache(maxsize=None)
+def find_gnu_tar():
+    tar = shutil.which("tar")
+    if tar is None:
+        return None
+    try:
+        version = subprocess.check_output([tar, "--version"], encoding="utf-8")
+    except subprocess.CalledProcessError:
+        return None
+    if "GNU tar" not in version:
+        return None
+    return tar
+
+
+# Helpers to pass literal strings to GNU tar's --transform and --wildcards.
+_bre_special_regex = re.compile(r"([\\.*\[\]^$,])")
+_sed_repl_special_regex = re.compile(r"([\\&,])")
+_glob_special_regex = re.compile(r"([\\*?\[])")
+
+
+def _escape_bre(s):
+    return _bre_special_regex.sub(r"\\\1", s)
+
+
+def _escape_sed_repl(s):
+    return _sed_repl_special_regex.sub(r"\\\1", s)
+
+
+def _escape_glob(s):
+    return _glob_special_regex.sub(r"\\\1", s)
+
+
+# Creates a .tar.gz archive that contains the entries of a directory.
+# If pigz is available, compression is done by multiple threads outside of Python.
+def create_tar_gz(archive_file, root):
+    entries = sorted(os.listdir(root))
+    pigz = shutil.which("pigz")
+    if pigz is not None and entries:
+        subprocess.check_call(
+            ["tar", "--use-compress-program", pigz, "-cf", archive_file, "-C", root, "--"]
+            + entries
+        )
+        return
+
+    with tarfile.open(archive_file, "w:gz") as tar:
+        for ent in entries:
+            tar.add(os.path.join(root, ent), arcname=ent)
+
+
+# Counterpart of create_tar_gz().
+def extract_tar_gz(archive_file, root):
+    pigz = shutil.which("pigz")
+    if pigz is not None:
+        subprocess.check_call(
+            ["tar", "--use-compress-program", pigz, "-xf", archive_file, "-C", root]
+        )
+        return
+
+    with tarfile.open(archive_file, "r:gz") as tar:
+        for info in tar:
+            tar.extract(info, root)
+
+
 def archive_tool(cfg, tool):
-    with tarfile.open(tool.archive_file, "w:gz") as tar:
-        for ent in os.listdir(tool.prefix_dir):
-            tar.add(os.path.join(tool.prefix_dir, ent), arcname=ent)
+    create_tar_gz(tool.archive_file, tool.prefix_dir)
 
 
 # ---------------------------------------------------------------------------------------
@@ -2749,7 +3355,10 @@ def archive_tool(cfg, tool):
 # ---------------------------------------------------------------------------------------
 
 
-def configure_pkg(cfg, pkg, *, sysroot):
+def configure_pkg(cfg, pkg, *, sysroot, keep_configuration=False):
+    if keep_configuration and _try_keep_configuration(cfg, pkg, sysroot=sysroot):
+        return
+
     try_rmtree(pkg.build_dir)
     _util.try_mkdir(pkg.build_dir, True)
 
@@ -2763,6 +3372,7 @@ def configure_pkg(cfg, pkg, *, sysroot):
         )
 
     pkg.mark_as_configured()
+    _write_configure_stamp(cfg, pkg, sysroot=sysroot)
 
 
 def build_pkg(cfg, pkg, *, sysroot, reproduce=False):
@@ -2788,15 +3398,15 @@ def build_pkg(cfg, pkg, *, sysroot, reproduce=False):
 
         def discover_dirtree(root):
             s = set()
-
-            def recurse(subdir=""):
-                for dent in os.scandir(os.path.join(root, subdir)):
-                    path = os.path.join(subdir, dent.name)
-                    s.add(path)
-                    if dent.is_dir(follow_symlinks=False):
-                        recurse(path)
-
-            recurse()
+            # fwalk() resolves entries relative to directory fds and does not recurse in Python.
+            for dirpath, dirnames, filenames, _ in os.fwalk(root):
+                subdir = os.path.relpath(dirpath, root)
+                if subdir == ".":
+                    s.update(dirnames)
+                    s.update(filenames)
+                else:
+                    s.update(os.path.join(subdir, name) for name in dirnames)
+                    s.update(os.path.join(subdir, name) for name in filenames)
             return s
 
         repro_paths = discover_dirtree(pkg.collect_dir)
@@ -2810,13 +3420,14 @@ def build_pkg(cfg, pkg, *, sysroot, reproduce=False):
             )
         if exist_only:
             raise GenericError(
-                "Paths {} only exist in existing build".format(", ".join(repro_only))
+                "Paths {} only exist in existing build".format(", ".join(exist_only))
             )
 
         any_issues = False
-        for path in repro_paths:
+        compare_paths = []
+        for path in sorted(repro_paths):
             repro_stat = os.stat(os.path.join(pkg.collect_dir, path))
-            exist_stat = os.stat(os.path.join(pkg.collect_dir, path))
+            exist_stat = os.stat(os.path.join(pkg.staging_dir, path))
 
             if stat.S_IFMT(repro_stat.st_mode) != stat.S_IFMT(exist_stat.st_mode):
                 _util.log_info("File type mismatch in file {}".format(path))
@@ -2824,14 +3435,24 @@ def build_pkg(cfg, pkg, *, sysroot, reproduce=False):
                 continue
 
             if stat.S_ISREG(repro_stat.st_mode):
-                if not filecmp.cmp(
-                    os.path.join(pkg.collect_dir, path),
-                    os.path.join(pkg.staging_dir, path),
-                    shallow=False,
-                ):
+                if repro_stat.st_size != exist_stat.st_size:
                     _util.log_info("Content mismatch in file {}".format(path))
                     any_issues = True
                     continue
+                compare_paths.append(path)
+
+        # Reading the files dominates; reads release the GIL, so compare on a thread pool.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=get_concurrency()) as executor:
+            equal = executor.map(
+                lambda path: files_equal(
+                    os.path.join(pkg.collect_dir, path), os.path.join(pkg.staging_dir, path)
+                ),
+                compare_paths,
+            )
+            for path, is_equal in zip(compare_paths, equal):
+                if not is_equal:
+                    _util.log_info("Content mismatch in file {}".format(path))
+                    any_issues = True
 
         if not any_issues:
             _util.log_info("Build was reproduced exactly")
@@ -2931,12 +3552,12 @@ def pack_pkg(cfg, pkg, reproduce=False):
                 environ["XBPS_ARCH"] = arch
 
                 _util.log_info("Running {} ({})".format(args, arch))
-                subprocess.call(args, env=environ, stdout=output)
+                with cfg.xbps_repository_lock:
+                    subprocess.call(args, env=environ, stdout=output)
         else:
-            if not filecmp.cmp(
+            if not files_equal(
                 os.path.join(cfg.package_out_dir, xbps_file),
                 os.path.join(cfg.xbps_repository_dir, xbps_file),
-                shallow=False,
             ):
                 _util.log_info("Mismatch in {}".format(xbps_file))
                 raise GenericError("Could not reproduce pack")
@@ -2951,45 +3572,55 @@ def install_pkg(cfg, pkg, *, sysroot):
     _util.try_mkdir(sysroot)
 
     if cfg.use_xbps:
-        output = subprocess.DEVNULL
-        if verbosity:
-            output = None
+        install_xbps_pkgs(cfg, [pkg], sysroot=sysroot)
+    else:
+        installtree(pkg.staging_dir, sysroot)
+        pkg.mark_as_installed(sysroot=sysroot)
 
-        environ = os.environ.copy()
-        _util.build_environ_paths(
-            environ, "PATH", prepend=[os.path.join(_util.find_home(), "bin")]
-        )
-        # TODO: Instead of using the repoarch, this should be dependent on the sysroot
-        #       that we are installing into.
-        environ["XBPS_TARGET_ARCH"] = pkg.xbps_repo_arch
-        uname = os.uname()
-        environ["XBPS_ARCH"] = f"{uname.machine}-{uname.sysname}.HOST"
 
-        # Work around xbps: https://github.com/void-linux/xbps/issues/408
+# Installs multiple packages with a single xbps-install invocation.
+# All packages must have the same xbps_repo_arch.
+def install_xbps_pkgs(cfg, pkgs, *, sysroot):
+    assert cfg.use_xbps
+    _util.try_mkdir(sysroot)
+
+    output = subprocess.DEVNULL
+    if verbosity:
+        output = None
+
+    environ = os.environ.copy()
+    _util.build_environ_paths(environ, "PATH", prepend=[os.path.join(_util.find_home(), "bin")])
+    # TODO: Instead of using the repoarch, this should be dependent on the sysroot
+    #       that we are installing into.
+    (repo_arch,) = {pkg.xbps_repo_arch for pkg in pkgs}
+    environ["XBPS_TARGET_ARCH"] = repo_arch
+    uname = os.uname()
+    environ["XBPS_ARCH"] = f"{uname.machine}-{uname.sysname}.HOST"
+
+    # Work around xbps: https://github.com/void-linux/xbps/issues/408
+    for pkg in pkgs:
         args = ["xbps-remove", "-Fy", "-r", sysroot, pkg.name]
         _util.log_info("Running {}".format(args))
         subprocess.call(args, env=environ, stdout=output)
 
-        args = [
-            "xbps-install",
-            "-fyU",
-            "-r",
-            sysroot,
-            "--repository",
-            cfg.xbps_repository_dir,
-            pkg.name,
-        ]
-        _util.log_info("Running {}".format(args))
+    args = [
+        "xbps-install",
+        "-fyU",
+        "-r",
+        sysroot,
+        "--repository",
+        cfg.xbps_repository_dir,
+        *(pkg.name for pkg in pkgs),
+    ]
+    _util.log_info("Running {}".format(args))
+    try:
         subprocess.check_call(args, env=environ, stdout=output)
-    else:
-        installtree(pkg.staging_dir, sysroot)
-        pkg.mark_as_installed(sysroot=sysroot)
+    finally:
+        cfg.invalidate_xbps_pkg_states(sysroot)
 
 
 def archive_pkg(cfg, pkg):
-    with tarfile.open(pkg.archive_file, "w:gz") as tar:
-        for ent in os.listdir(pkg.staging_dir):
-            tar.add(os.path.join(pkg.staging_dir, ent), arcname=ent)
+    create_tar_gz(pkg.archive_file, pkg.staging_dir)
 
 
 def pull_pkg_pack(cfg, pkg):
@@ -3025,7 +3656,8 @@ def pull_pkg_pack(cfg, pkg):
         environ["XBPS_ARCH"] = arch
 
         _util.log_info("Running {} ({})".format(args, arch))
-        subprocess.call(args, env=environ, stdout=output)
+        with cfg.xbps_repository_lock:
+            subprocess.call(args, env=environ, stdout=output)
 
 
 def pull_archive(cfg, subject):
@@ -3045,9 +3677,7 @@ def pull_archive(cfg, subject):
 
         try_rmtree(subject.prefix_dir)
         os.mkdir(subject.prefix_dir)
-        with tarfile.open(subject.archive_file, "r:gz") as tar:
-            for info in tar:
-                tar.extract(info, subject.prefix_dir)
+        extract_tar_gz(subject.archive_file, subject.prefix_dir)
     else:
         # TODO: Also support packages here.
         raise GenericError("Unexpected subject for pull-archive")
@@ -3183,7 +3813,7 @@ class PlanState(Enum):
     ORDERED = 2
 
 
-class ExecutionStatus(Enum):
+class ExecutionStatus(IntEnum):
     NULL = 0
     SUCCESS = 1
     STEP_FAILED = 2
@@ -3213,7 +3843,122 @@ def determine_sysroot_id(action, subject):
     return tuple(sorted(pkgs))
 
 
+# Requirements of plan items that are added in addition to their build edges:
+# source, implicit package, package, tool and task dependencies of the subject, and the tool
+# dependencies of the tool that the subject belongs to ("tool-pkg").
+# Configuring packages requires all dependencies to be present. Usually, they will already be
+# installed during the configuration phase. However, if the sysroot is removed, building (and
+# installing) packages might need to install them again.
+_requirements_by_action = {
+    Action.REGENERATE_SRC: frozenset({"src", "tool"}),
+    Action.CONFIGURE_TOOL: frozenset({"src", "tool", "pkg", "task"}),
+    Action.COMPILE_TOOL_STAGE: frozenset({"src", "tool-pkg", "tool", "pkg", "task"}),
+    Action.INSTALL_TOOL_STAGE: frozenset({"tool-pkg", "tool", "pkg", "task"}),
+    Action.CONFIGURE_PKG: frozenset({"src", "implicit", "pkg", "tool", "task"}),
+    Action.BUILD_PKG: frozenset({"src", "implicit", "pkg", "tool", "task"}),
+    Action.REPRODUCE_BUILD_PKG: frozenset({"src", "implicit", "pkg", "tool", "task"}),
+    Action.INSTALL_PKG: frozenset({"implicit", "pkg"}),
+    Action.RUN: frozenset({"src", "implicit", "pkg", "tool", "task"}),
+    Action.RUN_PKG: frozenset({"implicit", "pkg", "tool", "task"}),
+    Action.RUN_TOOL: frozenset({"tool-pkg", "tool", "pkg", "task"}),
+}
+
+
+# Maps actions to functions that determine the ItemState of a PlanItem.
+_state_visitors = {
+    Action.FETCH_SRC: lambda item, s, c: s.check_if_fetched(c),
+    Action.CHECKOUT_SRC: lambda item, s, c: s.check_if_checkedout(c),
+    Action.PATCH_SRC: lambda item, s, c: s.check_if_patched(c),
+    Action.REGENERATE_SRC: lambda item, s, c: s.check_if_regenerated(c),
+    Action.CONFIGURE_TOOL: lambda item, s, c: s.check_if_configured(c),
+    Action.COMPILE_TOOL_STAGE: lambda item, s, c: s.check_if_compiled(c),
+    Action.INSTALL_TOOL_STAGE: lambda item, s, c: s.check_if_installed(c),
+    Action.CONFIGURE_PKG: lambda item, s, c: s.check_if_configured(c),
+    Action.BUILD_PKG: lambda item, s, c: s.check_staging(c),
+    Action.REPRODUCE_BUILD_PKG: lambda item, s, c: ItemState(missing=True),
+    Action.PACK_PKG: lambda item, s, c: s.check_if_packed(c),
+    Action.REPRODUCE_PACK_PKG: lambda item, s, c: ItemState(missing=True),
+    Action.INSTALL_PKG: lambda item, s, c: s.check_if_installed(c, sysroot=item.get_sysroot()),
+    Action.ARCHIVE_TOOL: lambda item, s, c: s.check_if_archived(c),
+    Action.ARCHIVE_PKG: lambda item, s, c: ItemState(missing=True),
+    Action.PULL_PKG_PACK: lambda item, s, c: s.check_if_pull_needed(c),
+    Action.PULL_ARCHIVE: lambda item, s, c: s.check_pull_archive(c),
+    Action.RUN: lambda item, s, c: ItemState(missing=True),
+    Action.RUN_PKG: lambda item, s, c: ItemState(missing=True),
+    Action.RUN_TOOL: lambda item, s, c: ItemState(missing=True),
+    Action.WANT_TOOL: lambda item, s, c: s.check_if_fully_installed(c),
+    Action.WANT_PKG: lambda item, s, c: s.check_want_pkg(c),
+    Action.MIRROR_SRC: lambda item, s, c: s.check_if_mirrord(c),
+}
+
+
+# 'want' actions denote dependencies outside of the build scope.
+# If they are activated, the plan fails unconditionally.
+def _fail_want_action(cfg, item):
+    raise ExecutionFailureError(item.action, item.subject)
+
+
+# Maps actions to functions that run a PlanItem.
+_action_handlers = {
+    Action.FETCH_SRC: lambda cfg, item: fetch_src(cfg, item.subject),
+    Action.CHECKOUT_SRC: lambda cfg, item: checkout_src(cfg, item.subject, item.settings),
+    Action.PATCH_SRC: lambda cfg, item: patch_src(cfg, item.subject),
+    Action.REGENERATE_SRC: lambda cfg, item: regenerate_src(cfg, item.subject),
+    Action.CONFIGURE_TOOL: lambda cfg, item: configure_tool(
+        cfg, item.subject, keep_configuration=_may_keep_configuration(item)
+    ),
+    Action.COMPILE_TOOL_STAGE: lambda cfg, item: compile_tool_stage(cfg, item.subject),
+    Action.INSTALL_TOOL_STAGE: lambda cfg, item: install_tool_stage(cfg, item.subject),
+    Action.CONFIGURE_PKG: lambda cfg, item: configure_pkg(
+        cfg,
+        item.subject,
+        sysroot=item.get_sysroot(),
+        keep_configuration=_may_keep_configuration(item),
+    ),
+    Action.BUILD_PKG: lambda cfg, item: build_pkg(cfg, item.subject, sysroot=item.get_sysroot()),
+    Action.REPRODUCE_BUILD_PKG: lambda cfg, item: build_pkg(
+        cfg, item.subject, sysroot=item.get_sysroot(), reproduce=True
+    ),
+    Action.PACK_PKG: lambda cfg, item: pack_pkg(cfg, item.subject),
+    Action.REPRODUCE_PACK_PKG: lambda cfg, item: pack_pkg(cfg, item.subject, reproduce=True),
+    Action.INSTALL_PKG: lambda cfg, item: install_pkg(
+        cfg, item.subject, sysroot=item.get_sysroot()
+    ),
+    Action.ARCHIVE_TOOL: lambda cfg, item: archive_tool(cfg, item.subject),
+    Action.ARCHIVE_PKG: lambda cfg, item: archive_pkg(cfg, item.subject),
+    Action.PULL_PKG_PACK: lambda cfg, item: pull_pkg_pack(cfg, item.subject),
+    Action.PULL_ARCHIVE: lambda cfg, item: pull_archive(cfg, item.subject),
+    Action.RUN: lambda cfg, item: run_task(cfg, item.subject),
+    Action.RUN_PKG: lambda cfg, item: run_pkg_task(cfg, item.subject),
+    Action.RUN_TOOL: lambda cfg, item: run_tool_task(cfg, item.subject),
+    Action.WANT_TOOL: _fail_want_action,
+    Action.WANT_PKG: _fail_want_action,
+    Action.MIRROR_SRC: lambda cfg, item: mirror_src(cfg, item.subject),
+}
+
+
 class PlanItem:
+    # Plans can have thousands of items; slots save the per-instance __dict__.
+    __slots__ = [
+        "plan",
+        "key",
+        "settings",
+        "id",
+        "sysroot_id",
+        "display_name",
+        "_state",
+        "active",
+        "build_edges",
+        "require_edges",
+        "order_before_edges",
+        "order_after_edges",
+        "build_edge_items",
+        "require_edge_items",
+        "edge_list",
+        "reverse_edge_list",
+        "outdated",
+    ]
+
     @staticmethod
     def get_ordering_key(item):
         # Pull packages as early as possible, install them as late as possible.
@@ -3245,6 +3990,7 @@ class PlanItem:
         self.plan = plan
         self.key = key
         self.settings = settings
+        self.id = None  # Dense index into Plan._item_list; assigned during materialization.
         self.sysroot_id = None
         if plan.isolate_sysroots:
             if self.action == Action.INSTALL_PKG:
@@ -3253,6 +3999,16 @@ class PlanItem:
                 assert key.target_sysroot_id is None
                 self.sysroot_id = determine_sysroot_id(self.action, self.subject)
 
+        # Name of the subject as it is displayed in the plan and in failure reports.
+        subject = key.subject
+        if isinstance(subject, HostStage):
+            if subject.stage_name:
+                self.display_name = f"{subject.pkg.name}, stage: {subject.stage_name}"
+            else:
+                self.display_name = subject.pkg.name
+        else:
+            self.display_name = subject.name
+
         self._state = None
         self.active = False
         # The following edge sets store PlanKeys.
@@ -3260,16 +4016,14 @@ class PlanItem:
         self.require_edges = set()
         self.order_before_edges = set()
         self.order_after_edges = set()
+        # Resolved build_edges and require_edges (see Plan._do_ordering()).
+        self.build_edge_items = []
+        self.require_edge_items = []
 
-        self.plan_state = PlanState.NULL
         self.edge_list = []  # Stores PlanItems.
         self.reverse_edge_list = []  # Stores PlanItems.
-        self.resolved_n = 0  # Number of resolved edges.
-        self.build_span = False
         self.outdated = False
 
-        self.exec_status = ExecutionStatus.NULL
-
     @property
     def action(self):
         return self.key.action
@@ -3299,32 +4053,7 @@ class PlanItem:
     def _determine_state(self):
         if self._state is not None:
             return
-        visitors = {
-            Action.FETCH_SRC: lambda s, c: s.check_if_fetched(c),
-            Action.CHECKOUT_SRC: lambda s, c: s.check_if_checkedout(c),
-            Action.PATCH_SRC: lambda s, c: s.check_if_patched(c),
-            Action.REGENERATE_SRC: lambda s, c: s.check_if_regenerated(c),
-            Action.CONFIGURE_TOOL: lambda s, c: s.check_if_configured(c),
-            Action.COMPILE_TOOL_STAGE: lambda s, c: s.check_if_compiled(c),
-            Action.INSTALL_TOOL_STAGE: lambda s, c: s.check_if_installed(c),
-            Action.CONFIGURE_PKG: lambda s, c: s.check_if_configured(c),
-            Action.BUILD_PKG: lambda s, c: s.check_staging(c),
-            Action.REPRODUCE_BUILD_PKG: lambda s, c: ItemState(missing=True),
-            Action.PACK_PKG: lambda s, c: s.check_if_packed(c),
-            Action.REPRODUCE_PACK_PKG: lambda s, c: ItemState(missing=True),
-            Action.INSTALL_PKG: lambda s, c: s.check_if_installed(c, sysroot=self.get_sysroot()),
-            Action.ARCHIVE_TOOL: lambda s, c: s.check_if_archived(c),
-            Action.ARCHIVE_PKG: lambda s, c: ItemState(missing=True),
-            Action.PULL_PKG_PACK: lambda s, c: s.check_if_pull_needed(c),
-            Action.PULL_ARCHIVE: lambda s, c: s.check_pull_archive(c),
-            Action.RUN: lambda s, c: ItemState(missing=True),
-            Action.RUN_PKG: lambda s, c: ItemState(missing=True),
-            Action.RUN_TOOL: lambda s, c: ItemState(missing=True),
-            Action.WANT_TOOL: lambda s, c: s.check_if_fully_installed(c),
-            Action.WANT_PKG: lambda s, c: s.check_want_pkg(c),
-            Action.MIRROR_SRC: lambda s, c: s.check_if_mirrord(c),
-        }
-        self._state = visitors[self.action](self.subject, self.settings)
+        self._state = _state_visitors[self.action](self, self.subject, self.settings)
 
 
 class ProgramFailureError(Exception):
@@ -3350,13 +4079,25 @@ class PlanFailureError(Exception):
         super().__init__("Plan failed")
 
 
+# Annotations of items in the printed plan.
+_active_tag = f"{colorama.Style.BRIGHT}*{colorama.Style.RESET_ALL} "
+_updatable_tag = (
+    f" ({colorama.Style.BRIGHT}{colorama.Fore.BLUE}updatable{colorama.Style.RESET_ALL})"
+)
+_outdated_tag = f" ({colorama.Style.BRIGHT}{colorama.Fore.BLUE}outdated{colorama.Style.RESET_ALL})"
+
+
 class Plan:
     def __init__(self, cfg):
         self._cfg = cfg
         self._order = []  # Stores PlanItems.
         self._visited_for_materialization = set()
-        self._visited_for_activation = set()
+        self._visited_for_activation = bytearray()  # Indexed by PlanItem.id.
+        self._ordered = False
+        self._activated = False
         self._items = dict()  # Maps PlanKey -> PlanItem.
+        self._item_list = []  # Stores PlanItems, indexed by PlanItem.id.
+        self._exec_status = bytearray()  # Stores ExecutionStatus values, indexed by PlanItem.id.
         self._stack = []  # Stores PlanKeys.
         self._settings = None
         self._sysroots = dict()  # Maps sysroot IDs to TemporaryDirectories
@@ -3378,6 +4119,11 @@ class Plan:
         self.keep_going = False
         self.isolate_sysroots = False
         self.progress_file = None
+        self._progress_lock = threading.Lock()
+        self._install_locks = dict()  # Maps install destinations to locks.
+        self._dep_edge_cache = dict()  # Maps (kind, subject, sysroot ID) to sets of PlanKeys.
+        self.jobs = 1
+        self.fetch_jobs = 8
 
         if self.cfg.auto_pull:
             self.use_auto_scope = True
@@ -3408,46 +4154,53 @@ class Plan:
             d = tempfile.TemporaryDirectory(prefix="sysroot.")
             self._sysroots[sysroot_id] = d
 
-        def add_implicit_pkgs():
-            if not subject.is_implicit:
-                for implicit in self._cfg.all_pkgs():
-                    if implicit.is_implicit:
-                        item.require_edges.add(
-                            PlanKey(Action.INSTALL_PKG, implicit, target_sysroot_id=sysroot_id)
-                        )
-
-        def add_source_dependencies(s):
+        # The edges that these helpers compute only depend on the subject (and on the sysroot for
+        # package dependencies), so they are computed once per plan and shared between items.
+        def cached_edges(kind, s, compute, *, per_sysroot=False):
+            cache_key = (kind, s, sysroot_id if per_sysroot else None)
+            edges = self._dep_edge_cache.get(cache_key)
+            if edges is None:
+                edges = frozenset(compute(s))
+                self._dep_edge_cache[cache_key] = edges
+            return edges
+
+        def compute_implicit_pkgs(_):
+            for implicit in self._cfg.all_pkgs():
+                if implicit.is_implicit:
+                    yield PlanKey(Action.INSTALL_PKG, implicit, target_sysroot_id=sysroot_id)
+
+        def compute_source_dependencies(s):
             for src_name in s.source_dependencies:
                 dep_source = self._cfg.get_source(src_name)
-                item.require_edges.add(PlanKey(Action.PATCH_SRC, dep_source))
+                yield PlanKey(Action.PATCH_SRC, dep_source)
 
-        def add_tool_dependencies(s):
+        def compute_tool_dependencies(s):
             for subject_id in s.tool_stage_dependencies:
                 (tool_name, stage_name) = (subject_id.name, subject_id.stage)
                 dep_tool = self._cfg.get_tool_pkg(tool_name)
                 if self.build_scope is not None and dep_tool not in self.build_scope:
                     if self.pull_out_of_scope:
-                        item.require_edges.add(PlanKey(Action.PULL_ARCHIVE, dep_tool))
+                        yield PlanKey(Action.PULL_ARCHIVE, dep_tool)
                     else:
-                        item.require_edges.add(PlanKey(Action.WANT_TOOL, dep_tool))
+                        yield PlanKey(Action.WANT_TOOL, dep_tool)
                 else:
                     tool_stage = dep_tool.get_stage(stage_name)
-                    item.require_edges.add(PlanKey(Action.INSTALL_TOOL_STAGE, tool_stage))
+                    yield PlanKey(Action.INSTALL_TOOL_STAGE, tool_stage)
 
-        def add_pkg_dependencies(s):
+        def compute_pkg_dependencies(s):
             for pkg_name in s.pkg_dependencies:
                 dep_pkg = self._cfg.get_target_pkg(pkg_name)
-                item.require_edges.add(
-                    PlanKey(Action.INSTALL_PKG, dep_pkg, target_sysroot_id=sysroot_id)
-                )
+                yield PlanKey(Action.INSTALL_PKG, dep_pkg, target_sysroot_id=sysroot_id)
 
-        def add_task_dependencies(s):
+        def compute_task_dependencies(s):
             for task_name in s.task_dependencies:
                 dep_task = self._cfg.get_task(task_name)
-                item.require_edges.add(PlanKey(Action.RUN, dep_task))
+                yield PlanKey(Action.RUN, dep_task)
+
+        def compute_tasks_ordered_before(s):
             for task_name in s.tasks_ordered_before:
                 dep_task = self._cfg.get_task(task_name)
-                item.order_before_edges.add(PlanKey(Action.RUN, dep_task))
+                yield PlanKey(Action.RUN, dep_task)
 
         if action == Action.FETCH_SRC:
             # FETCH_SRC has no dependencies.
@@ -3462,57 +4215,23 @@ class Plan:
         elif action == Action.REGENERATE_SRC:
             item.build_edges.add(PlanKey(Action.PATCH_SRC, subject))
 
-            add_source_dependencies(subject)
-            add_tool_dependencies(subject)
-
         elif action == Action.CONFIGURE_TOOL:
             src = self._cfg.get_source(subject.source)
             item.build_edges.add(PlanKey(Action.REGENERATE_SRC, src))
 
-            add_source_dependencies(subject)
-            add_tool_dependencies(subject)
-            add_pkg_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.COMPILE_TOOL_STAGE:
             item.build_edges.add(PlanKey(Action.CONFIGURE_TOOL, subject.pkg))
 
-            add_source_dependencies(subject)
-            add_tool_dependencies(subject.pkg)
-            add_tool_dependencies(subject)
-            add_pkg_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.INSTALL_TOOL_STAGE:
             item.build_edges.add(PlanKey(Action.COMPILE_TOOL_STAGE, subject))
 
-            add_tool_dependencies(subject.pkg)
-            add_tool_dependencies(subject)
-            add_pkg_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.CONFIGURE_PKG:
             src = self._cfg.get_source(subject.source)
             item.build_edges.add(PlanKey(Action.REGENERATE_SRC, src))
 
-            # Configuration requires all dependencies to be present.
-            add_source_dependencies(subject)
-            add_implicit_pkgs()
-            add_pkg_dependencies(subject)
-            add_tool_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.BUILD_PKG or action == Action.REPRODUCE_BUILD_PKG:
             item.build_edges.add(PlanKey(Action.CONFIGURE_PKG, subject))
 
-            # Usually dependencies will already be installed during the configuration phase.
-            # However, if the sysroot is removed, we might need to install again.
-            add_source_dependencies(subject)
-            add_implicit_pkgs()
-            add_pkg_dependencies(subject)
-            add_tool_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.PACK_PKG or action == Action.REPRODUCE_PACK_PKG:
             item.build_edges.add(PlanKey(Action.BUILD_PKG, subject))
 
@@ -3529,10 +4248,6 @@ class Plan:
             else:
                 item.build_edges.add(PlanKey(Action.BUILD_PKG, subject))
 
-            # See Action.BUILD_PKG for rationale.
-            add_implicit_pkgs()
-            add_pkg_dependencies(subject)
-
         elif action == Action.ARCHIVE_TOOL:
             for stage in subject.all_stages():
                 item.build_edges.add(PlanKey(Action.INSTALL_TOOL_STAGE, stage))
@@ -3546,28 +4261,37 @@ class Plan:
         ]:
             pass
 
-        elif action == Action.RUN:
-            add_source_dependencies(subject)
-            add_implicit_pkgs()
-            add_pkg_dependencies(subject)
-            add_tool_dependencies(subject)
-            add_task_dependencies(subject)
-
         elif action == Action.RUN_PKG:
             item.build_edges.add(PlanKey(Action.BUILD_PKG, subject.pkg))
-            add_implicit_pkgs()
-            add_pkg_dependencies(subject)
-            add_tool_dependencies(subject)
-            add_task_dependencies(subject)
 
         elif action == Action.RUN_TOOL:
             for stage in subject.pkg.all_stages():
                 item.build_edges.add(PlanKey(Action.COMPILE_TOOL_STAGE, stage))
 
-            add_tool_dependencies(subject.pkg)
-            add_tool_dependencies(subject)
-            add_pkg_dependencies(subject)
-            add_task_dependencies(subject)
+        # Add the requirements that are shared between actions (see _requirements_by_action).
+        # The (cached) edge sets are collected first and added to the item in a single update.
+        requirements = _requirements_by_action.get(action, ())
+        edge_sets = []
+        if "src" in requirements:
+            edge_sets.append(cached_edges("src", subject, compute_source_dependencies))
+        if "implicit" in requirements and not subject.is_implicit:
+            edge_sets.append(
+                cached_edges("implicit", None, compute_implicit_pkgs, per_sysroot=True)
+            )
+        if "pkg" in requirements:
+            edge_sets.append(
+                cached_edges("pkg", subject, compute_pkg_dependencies, per_sysroot=True)
+            )
+        if "tool" in requirements:
+            edge_sets.append(cached_edges("tool", subject, compute_tool_dependencies))
+        if "tool-pkg" in requirements:
+            edge_sets.append(cached_edges("tool", subject.pkg, compute_tool_dependencies))
+        if "task" in requirements:
+            edge_sets.append(cached_edges("task", subject, compute_task_dependencies))
+            item.order_before_edges.update(
+                cached_edges("task-order", subject, compute_tasks_ordered_before)
+            )
+        item.require_edges.update(*edge_sets)
 
         return item
 
@@ -3579,14 +4303,18 @@ class Plan:
             self._visited_for_materialization.add(edge)
             self._stack.append(edge)
 
+    # Returns the list of PlanItems that the edges resolve to.
     def _do_order_before(self, item, edges):
+        targets = []
         for edge in edges:
             assert isinstance(edge, PlanKey)
-            if edge not in self._items:
+            target = self._items.get(edge)
+            if target is None:
                 continue
-            target = self._items[edge]
             item.edge_list.append(target)
             target.reverse_edge_list.append(item)
+            targets.append(target)
+        return targets
 
     def _do_materialization(self):
         # First, call _materialize_item() on all (action, subject) pairs.
@@ -3600,16 +4328,23 @@ class Plan:
 
             # TODO: Store the subject.subject_id instead of the subject object (= the package)?
             item = self._materialize_item(key)
+            item.id = len(self._item_list)
             self._items[key] = item
+            self._item_list.append(item)
 
             self._do_materialization_visit(item.build_edges)
             self._do_materialization_visit(item.require_edges)
 
     def _do_ordering(self):
+        # Ordering edges must only be resolved once.
+        if self._ordered:
+            return
+        self._ordered = True
+
         # Resolve ordering edges.
-        for item in self._items.values():
-            self._do_order_before(item, item.build_edges)
-            self._do_order_before(item, item.require_edges)
+        for item in self._item_list:
+            item.build_edge_items = self._do_order_before(item, item.build_edges)
+            item.require_edge_items = self._do_order_before(item, item.require_edges)
             self._do_order_before(item, item.order_before_edges)
 
             for edge in item.order_after_edges:
@@ -3626,87 +4361,88 @@ class Plan:
             if self.ordering_prng:
                 self.ordering_prng.shuffle(items)
 
-        root_list = list(self._items.values())
+        root_list = list(self._item_list)
         sort_items(root_list)
         for item in root_list:
             sort_items(item.edge_list)
-
-        # The following code does a topologic sort of the desired items.
-        stack = []
-
-        def visit(item):
-            if item.plan_state == PlanState.NULL:
-                item.plan_state = PlanState.EXPANDING
-                stack.append(item)
-            elif item.plan_state == PlanState.EXPANDING:
-                for circ_item in stack:
-                    eprint(
-                        Action.strings[circ_item.action],
-                        stringify_subject_id(circ_item.subject.subject_id, with_type=False),
-                    )
-                raise GenericError("Package has circular dependencies")
-            else:
-                # Packages that are already ordered do not need to be considered again.
-                assert item.plan_state == PlanState.ORDERED
-
-        for root_item in root_list:
-            visit(root_item)
-
-            while stack:
-                item = stack[-1]
-                if item.resolved_n == len(item.edge_list):
-                    assert item.plan_state == PlanState.EXPANDING
-                    item.plan_state = PlanState.ORDERED
-                    stack.pop()
-                    self._order.append(item)
-                else:
-                    edge_item = item.edge_list[item.resolved_n]
-                    item.resolved_n += 1
-                    visit(edge_item)
+            sort_items(item.reverse_edge_list)
+
+        # The following code does a topologic sort of the desired items (using Kahn's algorithm).
+        # Ready items are kept on a stack such that the successors of an item tend to be ordered
+        # right after the item itself.
+        n_pending = [len(item.edge_list) for item in self._item_list]  # Indexed by PlanItem.id.
+        ready = [item for item in reversed(root_list) if not n_pending[item.id]]
+        while ready:
+            item = ready.pop()
+            self._order.append(item)
+            for succ_item in reversed(item.reverse_edge_list):
+                n_pending[succ_item.id] -= 1
+                if not n_pending[succ_item.id]:
+                    ready.append(succ_item)
+
+        if len(self._order) < len(self._item_list):
+            # Each remaining item has a remaining edge, so following those edges leads to a cycle.
+            item = next(item for item in root_list if n_pending[item.id])
+            path = dict()  # Maps PlanItem.id to PlanItems, in the order of discovery.
+            while item.id not in path:
+                path[item.id] = item
+                item = next(edge_item for edge_item in item.edge_list if n_pending[edge_item.id])
+            cycle = list(path.values())
+            for circ_item in reversed(cycle[cycle.index(item) :]):
+                eprint(
+                    Action.strings[circ_item.action],
+                    stringify_subject_id(circ_item.subject.subject_id, with_type=False),
+                )
+            raise GenericError("Package has circular dependencies")
 
     def _do_activation(self):
+        # Items are tracked by their (dense) IDs, which avoids hashing PlanKeys.
+        visited = self._visited_for_activation
+        visited.extend(bytes(len(self._item_list) - len(visited)))
+        stack = []  # Stores PlanItems.
+
         # Determine the items that will be enabled.
-        def visit(edges):
-            for edge in edges:
-                assert isinstance(edge, PlanKey)
-                if edge in self._visited_for_activation:
+        def visit(edge_items):
+            for item in edge_items:
+                if visited[item.id]:
                     continue
-                item = self._items[edge]
-                self._visited_for_activation.add(edge)
+                visited[item.id] = 1
                 if item.is_missing:
-                    self._stack.append(edge)
+                    stack.append(item)
 
-        def activate(root_key):
-            assert not self._stack
-            assert isinstance(root_key, PlanKey)
-            self._visited_for_activation.add(root_key)
-            self._stack.append(root_key)
+        def activate(root_item):
+            # The update loop below calls this once per active or outdated edge.
+            if root_item.active:
+                return
+            assert not stack
+            visited[root_item.id] = 1
+            stack.append(root_item)
 
-            while self._stack:
-                key = self._stack.pop()
-                item = self._items[key]
+            while stack:
+                item = stack.pop()
                 if item.active:
                     continue
                 item.active = True
 
-                visit(item.build_edges)
-                visit(item.require_edges)
+                visit(item.build_edge_items)
+                visit(item.require_edge_items)
+
+        # Items that are wanted or reachable from wanted items by build edges.
+        build_span = bytearray(len(self._item_list))  # Indexed by PlanItem.id.
 
         # Activate wanted items.
         for action, subject in self.wanted:
-            key = PlanKey(action, subject)
-            item = self._items[key]
-            item.build_span = True
+            item = self._items[PlanKey(action, subject)]
+            build_span[item.id] = 1
             if not self.check or item.is_missing:
-                activate(key)
+                activate(item)
 
         # Discover all items reachable by build edges.
         for item in reversed(self._order):
-            if not item.build_span:
+            if not build_span[item.id]:
                 continue
-            for dep_pair in item.build_edges:
-                dep_item = self._items[dep_pair]
-                dep_item.build_span = True
+            for dep_item in item.build_edge_items:
+                build_span[dep_item.id] = 1
 
         def is_outdated(item, dep_item):
             ts = item.timestamp
@@ -3718,31 +4454,29 @@ class Plan:
         # Handle --update and --recursive.
         if self.update or self.recursive:
             for item in self._order:
-                if self.restrict_updates and not item.build_span:
+                if self.restrict_updates and not build_span[item.id]:
                     continue
 
                 # Both --update and --recursive activate missing/updatable items.
                 if item.is_missing or item.is_updatable:
-                    activate(item.key)
+                    activate(item)
 
                 # Both --update and --recursive activate on outdated build edges.
-                for dep_pair in item.build_edges:
-                    dep_item = self._items[dep_pair]
+                for dep_item in item.build_edge_items:
                     if dep_item.active:
-                        activate(item.key)
+                        activate(item)
                     elif is_outdated(item, dep_item):
                         item.outdated = True
-                        activate(item.key)
+                        activate(item)
 
                 # Only --recursive activates on outdated requirements.
                 if self.recursive:
-                    for dep_pair in item.require_edges:
-                        dep_item = self._items[dep_pair]
+                    for dep_item in item.require_edge_items:
                         if dep_item.active:
-                            activate(item.key)
+                            activate(item)
                         elif is_outdated(item, dep_item):
                             item.outdated = True
-                            activate(item.key)
+                            activate(item)
 
     # Automatically restricts the build scope to local packages,
     # i.e., packages that are explicitly requested and packages that have existing build dirs.
@@ -3789,7 +4523,47 @@ class Plan:
 
         self.build_scope = scope
 
+    def _prime_sentinel_cache(self):
+        dirpaths = []
+        for item in self._item_list:
+            subject = item.subject
+            if isinstance(subject, Source):
+                dirpaths.append(subject.source_dir)
+            elif isinstance(subject, HostPackage):
+                dirpaths.append(subject.build_dir)
+            elif isinstance(subject, HostStage):
+                dirpaths.append(subject.pkg.build_dir)
+                dirpaths.append(os.path.join(subject.pkg.prefix_dir, "etc", "xbstrap"))
+            elif isinstance(subject, TargetPackage):
+                dirpaths.append(subject.build_dir)
+                if item.action == Action.INSTALL_PKG and not self._cfg.use_xbps:
+                    dirpaths.append(os.path.join(item.get_sysroot(), "etc", "xbstrap"))
+        self._cfg.sentinel_cache.prime(dirpaths)
+
+    # With --update or --recursive, activation inspects the state of every item.
+    # The probes are independent and mostly wait for git processes or the file system,
+    # so determine the states up front on a thread pool.
+    def _prime_item_states(self):
+        if not (self.update or self.recursive) or self.restrict_updates:
+            return
+        # PULL_PKG_PACK may download remote repodata; leave it to activation.
+        items = [item for item in self._item_list if item.action != Action.PULL_PKG_PACK]
+        if len(items) < 2:
+            return
+        with concurrent.futures.ThreadPoolExecutor(4 * get_concurrency()) as executor:
+            futures = [executor.submit(item._determine_state) for item in items]
+        for future in futures:
+            future.result()
+
     def compute_plan(self, no_ordering=False, no_activation=False):
+        # The plan is complete once it is activated; there is no need to compute it again
+        # (e.g., if run_plan() is called after compute_plan()).
+        if self._activated:
+            return
+
+        # Previous plans may have changed the state of build steps.
+        self._cfg.clear_state_caches()
+
         self._settings = ItemSettings()
         if self.update:
             self._settings.check_remotes = 1
@@ -3801,16 +4575,64 @@ class Plan:
             self._compute_auto_scope()
 
         self._do_materialization()
+        self._prime_sentinel_cache()
+        if self._settings.check_remotes:
+            # Query remotes in bulk rather than once per source while item states are determined.
+            self._settings.remote_commits = _vcs_utils.prefetch_remote_commits(
+                [item.subject for item in self._item_list if item.action == Action.FETCH_SRC],
+                check_remotes=self._settings.check_remotes,
+                max_workers=get_concurrency(),
+            )
         if no_ordering:
             return
         self._do_ordering()
         if no_activation:
             return
+        self._prime_item_states()
         self._do_activation()
+        self._activated = True
 
     def materialized_steps(self):
         return self._items.keys()
 
+    def _run_one(self, item):
+        handler = _action_handlers.get(item.action)
+        if handler is None:
+            raise AssertionError("Unexpected action")
+        handler(self._cfg, item)
+
+    def _emit_progress(self, n, n_all, item, status):
+        if self.progress_file is None:
+            return
+        (action, subject) = (item.action, item.subject)
+        yml = {
+            "n_this": n + 1,
+            "n_all": n_all,
+            "status": status,
+            "action": Action.strings[action],
+            "subject": stringify_subject_id(subject.subject_id, with_type=False),
+            "artifact_files": [],
+        }
+        if action == Action.ARCHIVE_TOOL:
+            yml["architecture"] = subject.architecture
+        if action == Action.PACK_PKG:
+            yml["architecture"] = subject.architecture
+        if action == Action.RUN:
+            for af in subject.artifact_files:
+                yml["artifact_files"].append(
+                    {
+                        "name": af.name,
+                        "filepath": af.filepath,
+                        "architecture": af.architecture,
+                    }
+                )
+
+        # Each record is formatted up front such that the lock is only held while writing.
+        # The lock keeps records of concurrently running items from interleaving.
+        buf = yaml.dump(yml, Dumper=global_yaml_dumper, explicit_end=True).encode("utf-8")
+        with self._progress_lock:
+            _write_all(self.progress_file.fileno(), buf)
+
     def run_plan(self):
         self.compute_plan()
 
@@ -3821,55 +4643,29 @@ class Plan:
             printed = self._order
         else:
             printed = scheduled
-        numbering = {item: i for i, item in enumerate(printed)}
+        numbering = [None] * len(self._item_list)  # Indexed by PlanItem.id.
+        for i, item in enumerate(printed):
+            numbering[item.id] = i
 
         if printed:
             _util.log_info("Running the following plan:")
         else:
             _util.log_info("Nothing to do")
         for item in printed:
-            (action, subject) = (item.action, item.subject)
             if self.explain:
-                symbol = f"#{numbering[item]}"
+                symbol = f"#{numbering[item.id]}"
                 eprint(f"{symbol:>5} ", end="")
                 if item.active:
-                    eprint(f"{colorama.Style.BRIGHT}*{colorama.Style.RESET_ALL} ", end="")
+                    eprint(_active_tag, end="")
                 else:
                     eprint("  ", end="")
             else:
                 eprint("    ", end="")
-            if isinstance(subject, HostStage):
-                if subject.stage_name:
-                    eprint(
-                        "{:14} {}, stage: {}".format(
-                            Action.strings[action], subject.pkg.name, subject.stage_name
-                        ),
-                        end="",
-                    )
-                else:
-                    eprint(
-                        "{:14} {}".format(Action.strings[action], subject.pkg.name),
-                        end="",
-                    )
-            else:
-                eprint(
-                    "{:14} {}".format(Action.strings[action], subject.name),
-                    end="",
-                )
+            eprint(f"{Action.strings[item.action]:14} {item.display_name}", end="")
             if item.is_updatable:
-                eprint(
-                    " ({}{}updatable{})".format(
-                        colorama.Style.BRIGHT, colorama.Fore.BLUE, colorama.Style.RESET_ALL
-                    ),
-                    end="",
-                )
+                eprint(_updatable_tag, end="")
             elif item.outdated:
-                eprint(
-                    " ({}{}outdated{})".format(
-                        colorama.Style.BRIGHT, colorama.Fore.BLUE, colorama.Style.RESET_ALL
-                    ),
-                    end="",
-                )
+                eprint(_outdated_tag, end="")
             if item.sysroot_id is not None:
                 sysroot_name = os.path.basename(self.get_sysroot(item.sysroot_id))
                 eprint(
@@ -3877,11 +4673,11 @@ class Plan:
                     end="",
                 )
             if self.explain:
-                required_by = sorted(item.reverse_edge_list, key=lambda it: numbering[it])
+                required_by = sorted(item.reverse_edge_list, key=lambda it: numbering[it.id])
                 if required_by:
                     eprint(
                         f" ({colorama.Fore.CYAN}required by: "
-                        + ", ".join(f"#{numbering[it]}" for it in required_by)
+                        + ", ".join(f"#{numbering[it.id]}" for it in required_by)
                         + f"{colorama.Style.RESET_ALL})",
                         end="",
                     )
@@ -3894,169 +4690,312 @@ class Plan:
 
         if self.dry_run:
             return
+        self._run_scheduled(scheduled)
+
+    def _load_timings(self):
+        try:
+            with open(self._timings_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return dict()
+
+    def _save_timings(self, timings):
+        _util.try_mkdir(os.path.dirname(self._timings_path), recursive=True)
+        # Unlike NamedTemporaryFile (which always uses mode 0600), respect the umask.
+        temp_path = f"{self._timings_path}.{os.getpid()}"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        with open(fd, "w") as f:
+            json.dump(timings, f)
+        os.replace(temp_path, self._timings_path)
+
+    @property
+    def _timings_path(self):
+        return os.path.join(self._cfg.build_root, ".xbstrap", "timings.json")
+
+    # Items that install into the same directory must not run concurrently
+    # (e.g., xbps-install refuses to run while the sysroot's pkgdb is locked).
+    def _install_lock(self, item):
+        if self.jobs <= 1:
+            return None
+        if item.action == Action.INSTALL_PKG:
+            dest = item.get_sysroot()
+        elif item.action == Action.INSTALL_TOOL_STAGE:
+            dest = item.subject.pkg.prefix_dir
+        else:
+            return None
+        # Note that dict.setdefault() is atomic, so no other lock is required here.
+        return self._install_locks.setdefault(dest, threading.Lock())
+
+    # INSTALL_PKG items with xbps are batched if they are ready at the same time.
+    # Returns a key that identifies items that can be batched, or None.
+    def _batch_key(self, item):
+        if item.action != Action.INSTALL_PKG or not self._cfg.use_xbps:
+            return None
+        return (item.get_sysroot(), item.subject.xbps_repo_arch)
+
+    def _run_timed(self, item):
+        start = time.monotonic()
+        try:
+            self._run_one(item)
+        except (
+            subprocess.CalledProcessError,
+            ProgramFailureError,
+            ExecutionFailureError,
+        ):
+            return (ExecutionStatus.STEP_FAILED, None)
+        return (ExecutionStatus.SUCCESS, time.monotonic() - start)
+
+    # Runs a batch of items (see _batch_key()). Returns a list of (status, elapsed) pairs.
+    def _run_batch(self, items):
+        lock = self._install_lock(items[0])
+        if lock is not None:
+            lock.acquire()
+        try:
+            if len(items) > 1:
+                start = time.monotonic()
+                try:
+                    install_xbps_pkgs(
+                        self._cfg,
+                        [item.subject for item in items],
+                        sysroot=items[0].get_sysroot(),
+                    )
+                except subprocess.CalledProcessError:
+                    # Fall back to individual installations to find the culprit.
+                    _util.log_warn("Batched installation failed, installing packages one by one")
+                else:
+                    elapsed = (time.monotonic() - start) / len(items)
+                    return [(ExecutionStatus.SUCCESS, elapsed)] * len(items)
+            return [self._run_timed(item) for item in items]
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _run_scheduled(self, scheduled):
+        n_all = len(scheduled)
+        exec_status = self._exec_status = bytearray(len(self._item_list))
+        position = [None] * len(self._item_list)  # Indexed by PlanItem.id.
+        for i, item in enumerate(scheduled):
+            position[item.id] = i
+        timings = self._load_timings()
+        action_strs = [Action.strings[item.action] for item in scheduled]
+        timing_keys = [
+            f"{action_str} {stringify_subject_id(item.subject.subject_id)}"
+            for (action_str, item) in zip(action_strs, scheduled)
+        ]
+
+        # Edges to inactive items are always satisfied. Note that scheduled is in topological
+        # order, i.e., all successors of an item appear after the item itself.
+        successors = [[] for _ in scheduled]
+        n_pending = [0] * n_all
+        for i, item in enumerate(scheduled):
+            for edge_id in {edge_item.id for edge_item in item.edge_list if edge_item.active}:
+                successors[position[edge_id]].append(i)
+                n_pending[i] += 1
+
+        # Plans with a single item (e.g., when a single step is re-run) are always run directly,
+        # without computing priorities or starting a thread pool.
+        parallel = self.jobs > 1 and n_all > 1
+
+        if parallel:
+            # Prefer items on the longest remaining path through the plan, where each item is
+            # weighted by its run time in previous builds (or the average if it is unknown).
+            known = [timings[key] for key in timing_keys if key in timings]
+            default_cost = sum(known) / len(known) if known else 1.0
+            path_cost = [0.0] * n_all
+            for i in reversed(range(n_all)):
+                path_cost[i] = timings.get(timing_keys[i], default_cost) + max(
+                    (path_cost[j] for j in successors[i]), default=0.0
+                )
+
+            def priority(i):
+                return (-path_cost[i], -len(successors[i]), i)
+
+        else:
+            # Without parallelism, simply run the items in the order of the plan.
+            def priority(i):
+                return (i,)
+
+        # Fetching sources is network-bound, so FETCH_SRC items have their own ready heap
+        # and are run concurrently (up to fetch_jobs at a time) in addition to other items.
+        def is_fetch(i):
+            return scheduled[i].action == Action.FETCH_SRC
+
+        ready = [priority(i) for i in range(n_all) if not n_pending[i] and not is_fetch(i)]
+        ready_fetches = [priority(i) for i in range(n_all) if not n_pending[i] and is_fetch(i)]
+        heapq.heapify(ready)
+        heapq.heapify(ready_fetches)
+        numbering = dict()  # Maps indices into scheduled to the position in the execution order.
+        running = dict()  # Maps futures to lists of indices into scheduled.
+        running_fetches = set()  # Futures of FETCH_SRC items.
+        failed = []  # Stores pairs of indices into scheduled and lines of the failure report.
+        aborted_by = None  # Item that stops the execution (unless --keep-going is given).
+        timings_changed = False
+
+        def complete(i, status, elapsed=None):
+            nonlocal aborted_by, timings_changed
+
+            item = scheduled[i]
+            exec_status[item.id] = status
+            if status == ExecutionStatus.SUCCESS:
+                if elapsed is not None and timings.get(timing_keys[i]) != elapsed:
+                    timings[timing_keys[i]] = elapsed
+                    timings_changed = True
+                self._emit_progress(numbering[i], n_all, item, "success")
+            else:
+                line = f"    {action_strs[i]:14} {item.display_name}"
+                if status == ExecutionStatus.STEP_FAILED:
+                    self._emit_progress(numbering[i], n_all, item, "failure")
+                    if not self.keep_going and aborted_by is None:
+                        aborted_by = item
+                elif status == ExecutionStatus.PREREQS_FAILED:
+                    line += " (prerequisites failed)"
+                elif status == ExecutionStatus.NOT_WANTED:
+                    line += " (not wanted)"
+                failed.append((i, line))
+            for j in successors[i]:
+                n_pending[j] -= 1
+                if not n_pending[j]:
+                    heapq.heappush(ready_fetches if is_fetch(j) else ready, priority(j))
+
+        # Pops the next item from the ready heap, together with all items that it can be
+        # batched with (see _batch_key()). Batching pulls items ahead of their position in the
+        # plan, hence it is only done for parallel runs.
+        def take_batch():
+            i = heapq.heappop(ready)[-1]
+            if not parallel:
+                return [i]
+            key = self._batch_key(scheduled[i])
+            if key is None:
+                return [i]
+            others = []
+            rest = []
+            for entry in ready:
+                if self._batch_key(scheduled[entry[-1]]) == key:
+                    others.append(entry[-1])
+                else:
+                    rest.append(entry)
+            if others:
+                ready[:] = rest
+                heapq.heapify(ready)
+            return [i] + sorted(others)
+
+        def start(batch):
+            runnable = []
+            for i in batch:
+                if aborted_by is not None:
+                    break
+                if prepare(i):
+                    runnable.append(i)
+            if not runnable:
+                return
+            if executor is None or not (parallel or is_fetch(runnable[0])):
+                for i, result in zip(runnable, self._run_batch([scheduled[i] for i in runnable])):
+                    complete(i, *result)
+            else:
+                future = executor.submit(self._run_batch, [scheduled[i] for i in runnable])
+                running[future] = runnable
+                if is_fetch(runnable[0]):
+                    running_fetches.add(future)
 
-        any_failed_items = False
-        for n, item in enumerate(scheduled):
+        # Returns true if the item should be run.
+        def prepare(i):
+            nonlocal aborted_by
+
+            item = scheduled[i]
             (action, subject) = (item.action, item.subject)
+            action_str = action_strs[i]
+            subject_str = stringify_subject_id(subject.subject_id, with_type=False)
+            n = len(numbering)
+            numbering[i] = n
 
             # Check if any prerequisites failed; this can generally only happen with --keep-going.
             any_failed_edges = False
             for edge_item in item.edge_list:
                 if not edge_item.active:
                     continue
-                assert edge_item.exec_status != ExecutionStatus.NULL
-                if edge_item.exec_status != ExecutionStatus.SUCCESS:
+                assert exec_status[edge_item.id] != ExecutionStatus.NULL
+                if exec_status[edge_item.id] != ExecutionStatus.SUCCESS:
                     any_failed_edges = True
 
-            def emit_progress(status):
-                if self.progress_file is not None:
-                    yml = {
-                        "n_this": n + 1,
-                        "n_all": len(scheduled),
-                        "status": status,
-                        "action": Action.strings[action],
-                        "subject": stringify_subject_id(subject.subject_id, with_type=False),
-                        "artifact_files": [],
-                    }
-                    if action == Action.ARCHIVE_TOOL:
-                        yml["architecture"] = subject.architecture
-                    if action == Action.PACK_PKG:
-                        yml["architecture"] = subject.architecture
-                    if action == Action.RUN:
-                        for af in subject.artifact_files:
-                            yml["artifact_files"].append(
-                                {
-                                    "name": af.name,
-                                    "filepath": af.filepath,
-                                    "architecture": af.architecture,
-                                }
-                            )
-                    self.progress_file.write(yaml.safe_dump(yml, explicit_end=True))
-                    self.progress_file.flush()
-
             if self.keep_going and any_failed_edges:
                 _util.log_info(
-                    "Skipping action {} of {} due to failed prerequisites [{}/{}]".format(
-                        Action.strings[action],
-                        stringify_subject_id(subject.subject_id, with_type=False),
-                        n + 1,
-                        len(scheduled),
-                    )
+                    f"Skipping action {action_str} of {subject_str}"
+                    f" due to failed prerequisites [{n + 1}/{n_all}]"
                 )
-                item.exec_status = ExecutionStatus.PREREQS_FAILED
-                emit_progress("prereqs-failed")
-                any_failed_items = True
-                continue
+                self._emit_progress(n, n_all, item, "prereqs-failed")
+                complete(i, ExecutionStatus.PREREQS_FAILED)
+                return False
 
             if self.only_wanted and (action, subject) not in self.wanted:
                 if not self.keep_going:
-                    raise ExecutionFailureError(action, subject)
-                item.exec_status = ExecutionStatus.NOT_WANTED
-                emit_progress("not-wanted")
-                any_failed_items = True
-                continue
+                    aborted_by = item
+                    return False
+                self._emit_progress(n, n_all, item, "not-wanted")
+                complete(i, ExecutionStatus.NOT_WANTED)
+                return False
 
             assert not any_failed_edges
-            _util.log_info(
-                "{} {} [{}/{}]".format(
-                    Action.strings[action],
-                    stringify_subject_id(subject.subject_id, with_type=False),
-                    n + 1,
-                    len(scheduled),
-                )
+            _util.log_info(f"{action_str} {subject_str} [{n + 1}/{n_all}]")
+            return True
+
+        executor = None
+        n_fetches = sum(1 for i in range(n_all) if is_fetch(i))
+        if parallel or (self.fetch_jobs > 1 and n_fetches > 1):
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs + self.fetch_jobs
             )
-            try:
-                if action == Action.FETCH_SRC:
-                    fetch_src(self._cfg, subject)
-                elif action == Action.CHECKOUT_SRC:
-                    checkout_src(self._cfg, subject, self._settings)
-                elif action == Action.PATCH_SRC:
-                    patch_src(self._cfg, subject)
-                elif action == Action.REGENERATE_SRC:
-                    regenerate_src(self._cfg, subject)
-                elif action == Action.CONFIGURE_TOOL:
-                    configure_tool(self._cfg, subject)
-                elif action == Action.COMPILE_TOOL_STAGE:
-                    compile_tool_stage(self._cfg, subject)
-                elif action == Action.INSTALL_TOOL_STAGE:
-                    install_tool_stage(self._cfg, subject)
-                elif action == Action.CONFIGURE_PKG:
-                    configure_pkg(self._cfg, subject, sysroot=item.get_sysroot())
-                elif action == Action.BUILD_PKG:
-                    build_pkg(self._cfg, subject, sysroot=item.get_sysroot())
-                elif action == Action.REPRODUCE_BUILD_PKG:
-                    build_pkg(self._cfg, subject, sysroot=item.get_sysroot(), reproduce=True)
-                elif action == Action.PACK_PKG:
-                    pack_pkg(self._cfg, subject)
-                elif action == Action.REPRODUCE_PACK_PKG:
-                    pack_pkg(self._cfg, subject, reproduce=True)
-                elif action == Action.INSTALL_PKG:
-                    install_pkg(self._cfg, subject, sysroot=item.get_sysroot())
-                elif action == Action.ARCHIVE_TOOL:
-                    archive_tool(self._cfg, subject)
-                elif action == Action.ARCHIVE_PKG:
-                    archive_pkg(self._cfg, subject)
-                elif action == Action.PULL_PKG_PACK:
-                    pull_pkg_pack(self._cfg, subject)
-                elif action == Action.PULL_ARCHIVE:
-                    pull_archive(self._cfg, subject)
-                elif action == Action.RUN:
-                    run_task(self._cfg, subject)
-                elif action == Action.RUN_PKG:
-                    run_pkg_task(self._cfg, subject)
-                elif action == Action.RUN_TOOL:
-                    run_tool_task(self._cfg, subject)
-                elif action == Action.WANT_TOOL:
-                    # 'want' actions denote dependencies outside of the build scope.
-                    # If they are activated, the plan fails unconditionally.
-                    raise ExecutionFailureError(action, subject)
-                elif action == Action.WANT_PKG:
-                    # 'want' actions denote dependencies outside of the build scope.
-                    # If they are activated, the plan fails unconditionally.
-                    raise ExecutionFailureError(action, subject)
-                elif action == Action.MIRROR_SRC:
-                    mirror_src(self._cfg, subject)
+        next_pos = 0  # Without parallelism: all items before this position have been started.
+        try:
+            # On failure, stop starting new items but let running items finish.
+            while running or ((ready or ready_fetches) and aborted_by is None):
+                while (
+                    ready_fetches
+                    and executor is not None
+                    and len(running_fetches) < max(self.fetch_jobs, 1)
+                    and aborted_by is None
+                ):
+                    start([heapq.heappop(ready_fetches)[-1]])
+                if parallel:
+                    while (
+                        ready
+                        and len(running) - len(running_fetches) < self.jobs
+                        and aborted_by is None
+                    ):
+                        start(take_batch())
                 else:
-                    raise AssertionError("Unexpected action")
-                item.exec_status = ExecutionStatus.SUCCESS
-                emit_progress("success")
-            except (
-                subprocess.CalledProcessError,
-                ProgramFailureError,
-                ExecutionFailureError,
-            ):
-                item.exec_status = ExecutionStatus.STEP_FAILED
-                emit_progress("failure")
-                if not self.keep_going:
-                    raise ExecutionFailureError(action, subject)
-                any_failed_items = True
-
-        if any_failed_items:
-            _util.log_info("The following steps failed:")
-            for item in scheduled:
-                (action, subject) = (item.action, item.subject)
-                assert item.exec_status != ExecutionStatus.NULL
-                if item.exec_status == ExecutionStatus.SUCCESS:
+                    # Without parallelism, all items except for fetches (which may run ahead on
+                    # the thread pool) run on the main thread, in the order of the plan.
+                    while next_pos < n_all and next_pos in numbering:
+                        next_pos += 1
+                    if next_pos < n_all and aborted_by is None:
+                        if ready and ready[0][-1] == next_pos:
+                            start(take_batch())
+                            continue
+                        if executor is None and ready_fetches and ready_fetches[0][-1] == next_pos:
+                            start([heapq.heappop(ready_fetches)[-1]])
+                            continue
+                if not running:
                     continue
-
-                if isinstance(subject, HostStage):
-                    if subject.stage_name:
-                        eprint(
-                            "    {:14} {}, stage: {}".format(
-                                Action.strings[action], subject.pkg.name, subject.stage_name
-                            ),
-                            end="",
-                        )
-                    else:
-                        eprint(
-                            "    {:14} {}".format(Action.strings[action], subject.pkg.name), end=""
-                        )
-                else:
-                    eprint("    {:14} {}".format(Action.strings[action], subject.name), end="")
-                if item.exec_status == ExecutionStatus.PREREQS_FAILED:
-                    eprint(" (prerequisites failed)", end="")
-                elif item.exec_status == ExecutionStatus.NOT_WANTED:
-                    eprint(" (not wanted)", end="")
-                eprint()
+                (done, _) = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in sorted(done, key=running.get):
+                    running_fetches.discard(future)
+                    for i, result in zip(running.pop(future), future.result()):
+                        complete(i, *result)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if timings_changed:
+                self._save_timings(timings)
+
+        if aborted_by is not None:
+            raise ExecutionFailureError(aborted_by.action, aborted_by.subject)
+
+        if failed:
+            # Report failures in plan order, even if they were encountered out of order.
+            failed.sort()
+            _util.log_info("The following steps failed:")
+            eprint("\n".join(line for (_, line) in failed), flush=True)
 
             raise PlanFailureError()
@@ -2,12 +2,15 @@
 
 import re
 
+_fd_spec_regex = re.compile(r"fd:(\d+)")
+_path_spec_regex = re.compile(r"path:(.+)")
+
 
 def open_file_from_cli(spec, *args, **kwargs):
-    m = re.match(r"fd:(\d+)", spec)
+    m = _fd_spec_regex.match(spec)
     if m is not None:
         return open(int(m.group(1)), *args, **kwargs)
-    m = re.match(r"path:(.+)", spec)
+    m = _path_spec_regex.match(spec)
     if m is not None:
         return open(m.group(1), *args, **kwargs)
     raise ValueError("Illegal file specification on CLI")
@@ -6,42 +6,36 @@ import fcntl
 import os
 import os.path as path
 import sys
-import urllib.parse
-import urllib.request
+import threading
 
 import colorama
 
+# Serializes output of concurrently running build steps. Note that print() may issue multiple
+# writes per call (e.g., colorama splits writes at escape sequences).
+_eprint_lock = threading.Lock()
+
 
 def eprint(*args, **kwargs):
-    return print(*args, **kwargs, file=sys.stderr)
+    with _eprint_lock:
+        return print(*args, **kwargs, file=sys.stderr)
+
+
+# The prefixes are constant, so only build them once.
+_info_prefix = f"{colorama.Style.BRIGHT}xbstrap{colorama.Style.RESET_ALL}: "
+_warn_prefix = f"{colorama.Style.BRIGHT}xbstrap{colorama.Style.NORMAL}: {colorama.Fore.YELLOW}"
+_err_prefix = f"{colorama.Style.BRIGHT}xbstrap{colorama.Style.NORMAL}: {colorama.Fore.RED}"
 
 
 def log_info(msg):
-    eprint("{}xbstrap{}: {}".format(colorama.Style.BRIGHT, colorama.Style.RESET_ALL, msg))
+    eprint(f"{_info_prefix}{msg}")
 
 
 def log_warn(msg):
-    eprint(
-        "{}xbstrap{}: {}{}{}".format(
-            colorama.Style.BRIGHT,
-            colorama.Style.NORMAL,
-            colorama.Fore.YELLOW,
-            msg,
-            colorama.Style.RESET_ALL,
-        )
-    )
+    eprint(f"{_warn_prefix}{msg}{colorama.Style.RESET_ALL}")
 
 
 def log_err(msg):
-    eprint(
-        "{}xbstrap{}: {}{}{}".format(
-            colorama.Style.BRIGHT,
-            colorama.Style.NORMAL,
-            colorama.Fore.RED,
-            msg,
-            colorama.Style.RESET_ALL,
-        ),
-    )
+    eprint(f"{_err_prefix}{msg}{colorama.Style.RESET_ALL}")
 
 
 def find_home():
@@ -73,6 +67,10 @@ def build_environ_paths(environ, varname, prepend):
 
 def interactive_download(url, path):
     istty = os.isatty(1)  # This is stdout.
+    # Steps only run outside of the main thread if they can run concurrently. In this case,
+    # do not draw a status line since it would be overwritten by the output of other steps.
+    if threading.current_thread() is not threading.main_thread():
+        istty = False
     if istty:
         eprint("...", end="")  # This will become the status line.
 
@@ -103,6 +101,9 @@ def interactive_download(url, path):
             end=newline,
         )
 
+    # urllib.request pulls in http, email and ssl; only import it when downloading.
+    import urllib.request
+
     temp_path = path + ".download"
     urllib.request.urlretrieve(url, temp_path, show_progress)
     os.rename(temp_path, path)
@@ -1,11 +1,12 @@
 # SPDX-License-Identifier: MIT
 
+import concurrent.futures
 import hashlib
 import os
 import re
 import shutil
 import subprocess
-import urllib.request
+import urllib.parse
 from enum import Enum
 
 import xbstrap.util as _util
@@ -19,6 +20,7 @@ class RepoStatus(Enum):
 
 
 CHECKSUM_BLOCK_SIZE = 1048576
+DOWNLOAD_BLOCK_SIZE = 1048576
 DEFAULT_CHECKSUM_TYPE = "blake2b"
 HASHLIB_MAP = {
     "sha256": hashlib.sha256,
@@ -28,6 +30,8 @@ HASHLIB_MAP = {
 
 assert DEFAULT_CHECKSUM_TYPE in HASHLIB_MAP
 
+_git_version_regex = re.compile(r"^git version (\d+).(\d+).(\d+)")
+
 
 def vcs_name(src):
     if "git" in src._this_yml:
@@ -44,7 +48,7 @@ def vcs_name(src):
 
 def determine_git_version(git):
     output = subprocess.check_output([git, "version"], encoding="ascii")
-    matches = re.match(r"^git version (\d+).(\d+).(\d+)", output)
+    matches = _git_version_regex.match(output)
     if matches is None:
         raise RuntimeError(f"Could not parse git version string: '{output}'")
     return tuple(int(matches.group(i)) for i in range(1, 4))
@@ -82,15 +86,78 @@ def checksum_validate(source, source_archive_file, source_name, mandate_hashes):
             raise GenericError(f"Checksum for source '{source_name}' did not match")
 
 
-def check_repo(src, subdir, *, check_remotes=0):
+def _git_url(src):
+    xbstrap_mirror = src.cfg.xbstrap_mirror
+    if xbstrap_mirror is None:
+        return src._this_yml["git"]
+    return urllib.parse.urljoin(xbstrap_mirror + "/git/", src.name)
+
+
+# Returns the remote ref of a git source and the local ref that tracks it.
+def _git_refs(src):
+    if "tag" in src._this_yml:
+        return ("refs/tags/" + src._this_yml["tag"], "refs/tags/" + src._this_yml["tag"])
+    return (
+        "refs/heads/" + src._this_yml["branch"],
+        "refs/remotes/origin/" + src._this_yml["branch"],
+    )
+
+
+def _should_check_remote(src, check_remotes):
+    # Tags are only expected to change for check_remotes >= 2.
+    if check_remotes >= 2:
+        return True
+    return check_remotes >= 1 and "tag" not in src._this_yml
+
+
+# Returns a dict that maps each of the given refs to its commit (or None if the ref
+# does not exist or the remote cannot be reached).
+def ls_remote(git_url, refs):
+    try:
+        out = subprocess.check_output(["git", "ls-remote", git_url, *refs]).decode().splitlines()
+    except subprocess.CalledProcessError:
+        return {ref: None for ref in refs}
+    remote_commits = dict()
+    for line in out:
+        (commit, outref) = line.split("\t")
+        remote_commits[outref] = commit
+    return {ref: remote_commits.get(ref) for ref in refs}
+
+
+# Determines the remote commits of all given sources that check_repo() would need to query.
+# Sources are grouped by URL such that each remote is only contacted once.
+# Returns a dict that maps (URL, ref) pairs to commits; it can be passed to check_repo().
+def prefetch_remote_commits(srcs, *, check_remotes, max_workers=None):
+    refs_per_url = dict()
+    for src in srcs:
+        if "git" not in src._this_yml or not _should_check_remote(src, check_remotes):
+            continue
+        git_url = _git_url(src)
+        if not isinstance(git_url, str):
+            continue
+        # Sources that are not checked out yet are reported as missing without a remote query.
+        if not os.path.isdir(os.path.join(src.sub_dir, src.name)):
+            continue
+        (ref, _) = _git_refs(src)
+        refs_per_url.setdefault(git_url, set()).add(ref)
+
+    remote_commits = dict()
+    if not refs_per_url:
+        return remote_commits
+    _util.log_info(f"Querying {len(refs_per_url)} remote(s) for updates")
+    urls = sorted(refs_per_url)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda url: ls_remote(url, sorted(refs_per_url[url])), urls)
+        for git_url, commits in zip(urls, results):
+            for ref, commit in commits.items():
+                remote_commits[(git_url, ref)] = commit
+    return remote_commits
+
+
+def check_repo(src, subdir, *, check_remotes=0, remote_commits=None):
     if "git" in src._this_yml:
         source_dir = os.path.join(subdir, src.name)
-
-        xbstrap_mirror = src.cfg.xbstrap_mirror
-        if xbstrap_mirror is None:
-            git_url = src._this_yml["git"]
-        else:
-            git_url = urllib.parse.urljoin(xbstrap_mirror + "/git/", src.name)
+        git_url = _git_url(src)
 
         def get_local_commit(ref):
             try:
@@ -110,6 +177,8 @@ def check_repo(src, subdir, *, check_remotes=0):
             return commit
 
         def get_remote_commit(ref):
+            if remote_commits is not None and (git_url, ref) in remote_commits:
+                return remote_commits[(git_url, ref)]
             try:
                 out = (
                     subprocess.check_output(["git", "ls-remote", "--exit-code", git_url, ref])
@@ -125,24 +194,12 @@ def check_repo(src, subdir, *, check_remotes=0):
         # There is a TOCTOU here; we assume that users do not concurrently delete directories.
         if not os.path.isdir(source_dir):
             return RepoStatus.MISSING
-        if "tag" in src._this_yml:
-            ref = "refs/tags/" + src._this_yml["tag"]
-            tracking_ref = "refs/tags/" + src._this_yml["tag"]
-        else:
-            ref = "refs/heads/" + src._this_yml["branch"]
-            tracking_ref = "refs/remotes/origin/" + src._this_yml["branch"]
+        (ref, tracking_ref) = _git_refs(src)
         local_commit = get_local_commit(tracking_ref)
         if local_commit is None:
             return RepoStatus.MISSING
 
-        # Only check remote commits for
-        do_check_remote = False
-        if check_remotes >= 2:
-            do_check_remote = True
-        if check_remotes >= 1 and "tag" not in src._this_yml:
-            do_check_remote = True
-
-        if do_check_remote:
+        if _should_check_remote(src, check_remotes):
             _util.log_info("Checking for remote updates of {}".format(src.name))
             remote_commit = get_remote_commit(ref)
             if local_commit != remote_commit:
@@ -185,6 +242,42 @@ def check_repo(src, subdir, *, check_remotes=0):
     return RepoStatus.GOOD
 
 
+# Makes sure that a commit is available after the branch that contains it was fetched.
+# Raises GenericError if the remote does not provide the commit.
+def _fetch_git_commit(git, source_dir, git_url, ref, commit, *, shallow):
+    def have_commit():
+        return (
+            subprocess.call(
+                [git, "cat-file", "-e", commit + "^{commit}"],
+                cwd=source_dir,
+                stderr=subprocess.DEVNULL,
+            )
+            == 0
+        )
+
+    if have_commit():
+        return
+
+    # Most servers allow fetching (reachable) commits by their SHA1.
+    # Only limit the depth if the repository is shallow anyway (otherwise, we would turn
+    # a full clone into a shallow one).
+    args = [git, "fetch"]
+    if shallow:
+        args.append("--depth=1")
+    args.extend([git_url, commit])
+    if subprocess.call(args, cwd=source_dir) == 0 and have_commit():
+        return
+
+    # Otherwise, fall back to fetching the branch's full history.
+    is_shallow = subprocess.check_output(
+        [git, "rev-parse", "--is-shallow-repository"], cwd=source_dir, encoding="ascii"
+    ).strip()
+    if is_shallow == "true":
+        subprocess.check_call([git, "fetch", "--unshallow", git_url, ref], cwd=source_dir)
+    if not have_commit():
+        raise GenericError(f"Commit {commit} is not reachable from {ref} of {git_url}")
+
+
 def fetch_repo(cfg, src, subdir, *, ignore_mirror=False, bare_repo=False):
     source = src._this_yml
 
@@ -245,6 +338,11 @@ def fetch_repo(cfg, src, subdir, *, ignore_mirror=False, bare_repo=False):
         if bare_repo:
             shallow = False
 
+        # Pinned commits are not necessarily part of a shallow fetch of the branch.
+        pinned_commit = None
+        if "tag" not in source and not bare_repo:
+            pinned_commit = source.get("commit", fixed_commit)
+
         fetch_succeeded = False
         fetch_failed_before = False
 
@@ -255,18 +353,14 @@ def fetch_repo(cfg, src, subdir, *, ignore_mirror=False, bare_repo=False):
                     args.append("--depth=1")
                 args.extend([git_url, "tag", source["tag"]])
             else:
-                # If a commit is specified, we need the branch's full history.
-                # TODO: it's unclear whether this is the best strategy:
-                #       - for simplicity, it might be easier to always pull the full history
-                #       - some remotes support fetching individual SHA1s.
-                if "commit" in source or fixed_commit is not None:
-                    shallow = False
-
                 # When initializing the repository, we fetch only one commit.
                 # For updates, we fetch all *new* commits (= default behavior of 'git fetch').
-                # We do not unshallow the repository.
+                # We do not unshallow the repository (unless a pinned commit requires it, see
+                # _fetch_git_commit()), but we allow git to move its shallow boundary.
                 if init and shallow:
                     args.append("--depth=1")
+                elif shallow:
+                    args.append("--update-shallow")
 
                 # For bare repos, we mirror the original repo
                 # (in particular, we do not distinguish local and remote branches).
@@ -295,9 +389,22 @@ def fetch_repo(cfg, src, subdir, *, ignore_mirror=False, bare_repo=False):
 
             try:
                 subprocess.check_call(args, cwd=source_dir)
+                if pinned_commit is not None:
+                    _fetch_git_commit(
+                        git,
+                        source_dir,
+                        git_url,
+                        "refs/heads/" + source["branch"],
+                        pinned_commit,
+                        shallow=shallow,
+                    )
             except subprocess.SubprocessError:
                 _util.log_warn(f'Fetching from git remote "{git_url}" failed')
                 fetch_failed_before = True
+            except GenericError as e:
+                # The remote lacks the pinned commit (e.g., an outdated mirror); try the next one.
+                _util.log_warn(str(e))
+                fetch_failed_before = True
             else:
                 if fetch_failed_before:
                     _util.log_warn(f'Fetching from fallback git remote "{git_url}" succeeded')
@@ -328,10 +435,13 @@ def fetch_repo(cfg, src, subdir, *, ignore_mirror=False, bare_repo=False):
         source_dir = os.path.join(subdir, src.name)
         source_archive_file = os.path.join(subdir, src.name + "." + src.source_archive_format)
 
+        import urllib.request  # Only needed here, see _util.interactive_download().
+
         _util.try_mkdir(source_dir)
         with urllib.request.urlopen(source["url"]) as req:
             with open(source_archive_file, "wb") as f:
-                shutil.copyfileobj(req, f)
+                # Use larger blocks than copyfileobj()'s default to reduce per-chunk overhead.
+                shutil.copyfileobj(req, f, DOWNLOAD_BLOCK_SIZE)
         checksum_validate(source, source_archive_file, src.name, cfg.mandate_hashes_for_archives)
     else:
         # VCS-less source.